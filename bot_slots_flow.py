@@ -20,14 +20,25 @@
 #   SLOTS    (e.g. "slot1,slot3,slot5,slot8,wallet")
 #   CREDIT_PHOTOS_PATH (default: /credit_photos)
 #
-# Requires: python-telegram-bot==21.6, aiosqlite
+# Requires: python-telegram-bot[rate-limiter]==21.6, aiosqlite
 
 import os
+import atexit
 import io
+import asyncio
+import contextlib
+import functools
+import itertools
+import hashlib
+import re
 import csv
 import logging
+import logging.handlers
 import aiosqlite
-import uuid
+import queue
+import sqlite3
+import time
+from dataclasses import dataclass
 from enum import IntEnum
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
@@ -37,15 +48,20 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
+from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
     ContextTypes,
+    Defaults,
     filters,
 )
+from telegram.helpers import escape_markdown
 from telegram.error import TelegramError
 
 __VERSION__ = "2.0.0"
@@ -58,9 +74,24 @@ logging.basicConfig(
 )
 log = logging.getLogger("bot_slots_flow")
 
+# Handlers write from a background thread: the event loop only enqueues records, so a
+# slow stdout/file never stalls update processing. Flushed and stopped at exit.
+_root_log = logging.getLogger()
+if _root_log.handlers and not any(isinstance(h, logging.handlers.QueueHandler) for h in _root_log.handlers):
+    _log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(_log_queue, *_root_log.handlers, respect_handler_level=True)
+    _root_log.handlers = [logging.handlers.QueueHandler(_log_queue)]
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
 def _log_event(evt: str, **kwargs):
-    extra = " ".join(f"{k}={v}" for k, v in kwargs.items())
-    log.info("%s %s", evt, extra)
+    # Skip building the k=v string when INFO is filtered out; list/tuple values (command
+    # args) are space-joined here so callers never pay for the join themselves
+    if not log.isEnabledFor(logging.INFO):
+        return
+    log.info("%s %s", evt, " ".join(
+        f"{k}={' '.join(v) if isinstance(v, (list, tuple)) else v}" for k, v in kwargs.items()
+    ))
 
 # ---- Config & Defaults ----
 
@@ -80,27 +111,133 @@ MAX_WALLET_KWH    = _as_float_env("MAX_WALLET_KWH", 10000.0)
 MAX_CREDIT_PER_OP = _as_float_env("MAX_CREDIT_PER_OP", 50000.0)
 MAX_PENDING_REQUESTS = 5
 
-def _env_allow_negative_default() -> bool:
-    return os.getenv("ALLOW_NEGATIVE", "0") == "1"
+# Read once: bound as a parameter in SQL instead of re-reading env per operation
+ALLOW_NEGATIVE_DEFAULT = os.getenv("ALLOW_NEGATIVE", "0") == "1"
 
-def _admin_ids() -> set[int]:
+def _admin_ids() -> frozenset[int]:
     ids = os.getenv("ADMIN_IDS", "").strip()
     if not ids:
-        return set()
+        return frozenset()
     try:
-        return set(int(x.strip()) for x in ids.split(",") if x.strip())
+        return frozenset(int(x.strip()) for x in ids.split(",") if x.strip())
     except Exception:
-        return set()
+        return frozenset()
 
 def _get_slots() -> list[str]:
     slots = os.getenv("SLOTS", "slot1,slot3,slot5,slot8,wallet").strip()
     return [s.strip() for s in slots.split(",") if s.strip()]
 
+# Parsed once at import; hot paths only do O(1) membership tests
 ADMIN_IDS = _admin_ids()
 SLOTS = _get_slots()
+_SLOTS_LOWER = frozenset(s.lower() for s in SLOTS)
 
 TZ = timezone(timedelta(hours=1))  # Europe/Rome
 
+# ---- In-process caches ----
+# Small per-user lookups ({key: (expires_at, value)}), invalidated on write.
+
+CACHE_TTL = 60.0
+CACHE_MAX = 2048
+_MISS = object()
+_name_cache: dict[int, tuple[float, object]] = {}
+_policy_cache: dict[int, tuple[float, object]] = {}
+_tgid_cache: dict[int, tuple[float, object]] = {}
+# Rendered /saldo texts {user_id: (expires_at, (name, balance, text))}, dropped by every
+# write to that user; name/balance guard against a render racing a write
+_saldo_cache: dict[int, tuple[float, object]] = {}
+# Rendered user-list pages {page: (expires_at, (markup, total))}: labels show names and
+# balances, so any write to those clears the whole thing
+_users_kb_cache: dict[int, tuple[float, object]] = {}
+
+def _cache_get(cache: dict, key):
+    hit = cache.get(key)
+    if hit is None or hit[0] < time.monotonic():
+        return _MISS
+    return hit[1]
+
+def _cache_put(cache: dict, key, value):
+    # Dicts keep insertion order: re-inserting moves the key to the end, so the
+    # first key is always the least recently written one
+    cache.pop(key, None)
+    if len(cache) >= CACHE_MAX:
+        del cache[next(iter(cache))]
+    cache[key] = (time.monotonic() + CACHE_TTL, value)
+    return value
+
+# ---- Shared connections ----
+# Two long-lived connections instead of a connect() per call. Writes go through _write_tx
+# (or hold _db_lock) on _db so transactions from concurrent handlers never interleave.
+# Plain reads use _read_db: on the writer's connection they would see the uncommitted
+# (and possibly rolled back) rows of an open BEGIN IMMEDIATE; under WAL the reader only
+# ever sees committed data and never waits for the writer.
+
+_db: aiosqlite.Connection | None = None
+_read_db: aiosqlite.Connection | None = None
+_db_lock = asyncio.Lock()
+
+# Per-connection settings: WAL lets readers run during a commit, NORMAL sync is safe under
+# WAL, 64MB page cache, in-memory temp b-trees (sorts) and 256MB of mmap'd reads
+_CONN_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "cache_size=-65536",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+)
+# Short-lived connections only need what changes commit cost and lock waits; the rest
+# pays off on the long-lived shared connection. (foreign_keys stays off: processed_by and
+# admin_id hold admin ids that need not have a users row.)
+_SHORT_CONN_PRAGMAS = (
+    "synchronous=NORMAL",
+    "busy_timeout=5000",
+)
+
+async def _apply_pragmas(db: aiosqlite.Connection, pragmas: tuple[str, ...]):
+    for pragma in pragmas:
+        await db.execute(f"PRAGMA {pragma}")
+
+@contextlib.asynccontextmanager
+async def _connect():
+    async with aiosqlite.connect(DB_PATH) as db:
+        await _apply_pragmas(db, _SHORT_CONN_PRAGMAS)
+        yield db
+
+async def get_db() -> aiosqlite.Connection:
+    global _db
+    if _db is None:
+        # Bigger prepared-statement cache (default 128): every query text of the bot stays compiled
+        _db = await aiosqlite.connect(DB_PATH, cached_statements=256)
+        await _apply_pragmas(_db, _CONN_PRAGMAS + ("busy_timeout=5000",))
+    return _db
+
+async def get_read_db() -> aiosqlite.Connection:
+    global _read_db
+    if _read_db is None:
+        _read_db = await aiosqlite.connect(DB_PATH, cached_statements=256)
+        await _apply_pragmas(_read_db, _CONN_PRAGMAS + ("busy_timeout=5000", "query_only=1"))
+    return _read_db
+
+async def close_db():
+    global _db, _read_db
+    if _read_db is not None:
+        await _read_db.close()
+        _read_db = None
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+@contextlib.asynccontextmanager
+async def _write_tx():
+    async with _db_lock:
+        db = await get_db()
+        try:
+            yield db
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+
 # ---- Database Migrations ----
 
 async def _get_table_columns(db, table: str) -> set[str]:
@@ -121,9 +258,22 @@ async def _table_exists(db, table: str) -> bool:
     row = await cur.fetchone()
     return row is not None
 
+# Bump whenever init_db gains a table/column/index change; stored in PRAGMA user_version
+SCHEMA_VERSION = 2
+
 async def init_db():
     _log_event("DB_INIT_START", db_path=DB_PATH)
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _connect() as db:
+        # WAL must be switched outside a transaction; it is persistent on the file
+        await db.execute("PRAGMA journal_mode=WAL")
+        cur = await db.execute("PRAGMA user_version")
+        (version,) = await cur.fetchone()
+        if version >= SCHEMA_VERSION:
+            _log_event("DB_INIT_DONE", schema=version, migrated=False)
+            return
+        # All idempotent migrations below run in one transaction: a single commit on boot
+        await db.execute("BEGIN")
+
         # 1) Ensure base tables exist
         await db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)")
         await db.execute("""
@@ -156,8 +306,6 @@ async def init_db():
                     FOREIGN KEY(processed_by) REFERENCES users(id)
                 )""")
             _log_event("DB_TABLE_CREATED", table="credit_requests")
-        
-        await db.commit()
 
         # 3) Users columns migration
         cols = await _get_table_columns(db, "users")
@@ -173,167 +321,352 @@ async def init_db():
         if "allow_negative_user" not in cols:
             await db.execute("ALTER TABLE users ADD COLUMN allow_negative_user INTEGER")
             _log_event("DB_MIGRATE_ADD_COL", table="users", column="allow_negative_user")
-        await db.commit()
 
         # 4) Backfill defaults
         await db.execute("UPDATE users SET wallet_kwh=0 WHERE wallet_kwh IS NULL")
-        await db.commit()
 
         # 5) Indices
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users(full_name)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_name_nocase ON users(full_name COLLATE NOCASE)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_allowneg ON users(allow_negative_user)")
+        # Covering index for the per-user "latest ops" reads (/saldo, /storico): no table lookups
+        await db.execute("DROP INDEX IF EXISTS idx_kwh_ops_user")
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_kwh_ops_user_cover
+            ON kwh_operations(user_id, id DESC, created_at, delta_kwh, reason, slot, admin_id)""")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_kwh_ops_created ON kwh_operations(created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_kwh_ops_user_created ON kwh_operations(user_id, created_at)")
+        # /pending (all users) filters on status and sorts newest first: range scan, no sort step
+        await db.execute("DROP INDEX IF EXISTS idx_credit_req_status")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_credit_req_status_created ON credit_requests(status, created_at DESC)")
+        # Per-user pending count/list seek straight to (user, 'pending') in date order
+        await db.execute("DROP INDEX IF EXISTS idx_credit_req_user")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_credit_req_user_status_created ON credit_requests(user_id, status, created_at DESC)")
+        await db.commit()
+
+        # Optional steps below may fail and are retried on the next boot: user_version is
+        # stamped only if every one of them succeeded
+        complete = True
+
+        # 5b) FTS5 mirror of users.full_name for admin search; optional if SQLite lacks FTS5
+        try:
+            await db.execute("BEGIN")
+            await db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                    full_name, content='users', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+            await db.execute("""
+                CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+                    INSERT INTO users_fts(rowid, full_name) VALUES (new.id, new.full_name);
+                END
+            """)
+            await db.execute("""
+                CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+                    INSERT INTO users_fts(users_fts, rowid, full_name) VALUES ('delete', old.id, old.full_name);
+                END
+            """)
+            # Only name changes touch the index; wallet updates skip the trigger
+            await db.execute("""
+                CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF full_name ON users BEGIN
+                    INSERT INTO users_fts(users_fts, rowid, full_name) VALUES ('delete', old.id, old.full_name);
+                    INSERT INTO users_fts(rowid, full_name) VALUES (new.id, new.full_name);
+                END
+            """)
+            await db.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            complete = False
+            log.warning("FTS5 user search not available: %s", e)
+
+        # 6) UNIQUE index kept out of the migration transaction: it fails on legacy duplicates
         try:
             await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_tgid ON users(tg_id)")
+            await db.commit()
         except Exception as e:
+            await db.rollback()
+            complete = False
             log.warning("UNIQUE index on tg_id not created: %s", e)
 
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_name ON users(full_name)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_allowneg ON users(allow_negative_user)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_kwh_ops_user ON kwh_operations(user_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_kwh_ops_created ON kwh_operations(created_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_credit_req_status ON credit_requests(status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_credit_req_user ON credit_requests(user_id)")
-        await db.commit()
-        _log_event("DB_INIT_DONE")
+        if complete:
+            await db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            await db.commit()
+        _log_event("DB_INIT_DONE", schema=SCHEMA_VERSION if complete else version, migrated=True, complete=complete)
 
 # ---- Helpers ----
 
+def _md(value) -> str:
+    """Escape user-supplied text (names, notes, reasons) for the default Markdown parse mode"""
+    return escape_markdown(str(value), version=1)
+
 def _is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-def _is_number(text: str) -> bool:
-    try:
-        float(str(text).replace(",", "."))
-        return True
-    except Exception:
-        return False
+def admin_only(handler):
+    """Stop non-admin updates before the handler body runs (and end any conversation)."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user and _is_admin(user.id):
+            return await handler(update, context)
+        if update.callback_query:
+            await update.callback_query.answer("Funzione riservata agli admin.", show_alert=True)
+        elif update.effective_message:
+            await update.effective_message.reply_text("Comando riservato agli admin.")
+        return ConversationHandler.END
+    return wrapper
+
+_AMOUNT_RE = re.compile(r"(\d+)(?:[.,](\d+))?")
+
+def _parse_amount(text: str) -> float | None:
+    """Unsigned kWh amount ("10", "15,345", "15.345") rounded to 3 decimals; None if malformed"""
+    m = _AMOUNT_RE.fullmatch(text)
+    if m is None:
+        return None
+    return round(float(f"{m[1]}.{m[2] or 0}"), 3)
 
 async def ensure_user(tg_id: int, full_name: str | None):
     """Create (id=tg_id) if missing; update name if changed."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    # Common path (known user, same name): one read, no write lock and no commit
+    db = await get_read_db()
+    cur = await db.execute("SELECT id, full_name FROM users WHERE tg_id=?", (tg_id,))
+    row = await cur.fetchone()
+    if row and (not full_name or full_name == row[1]):
+        return row[0]
+    async with _write_tx() as db:
+        # Re-read under the lock: a concurrent handler may have created/renamed it meanwhile.
+        # Plain INSERT/UPDATE, so this also works where idx_users_tgid could not be created.
         cur = await db.execute("SELECT id, full_name FROM users WHERE tg_id=?", (tg_id,))
         row = await cur.fetchone()
-        if row:
-            uid, old_name = row
-            if full_name and full_name != old_name:
-                await db.execute("UPDATE users SET full_name=? WHERE id=?", (full_name, uid))
-                await db.commit()
-            return uid
-        # Create new user
-        await db.execute("INSERT INTO users (id, tg_id, full_name, wallet_kwh) VALUES (?,?,?,0)", 
-                        (tg_id, tg_id, full_name or ""))
-        await db.commit()
-        _log_event("USER_CREATED", tg_id=tg_id, name=full_name or "")
-        return tg_id
+        if row is None:
+            await db.execute("INSERT INTO users (id, tg_id, full_name, wallet_kwh) VALUES (?,?,?,0)",
+                             (tg_id, tg_id, full_name or ""))
+            uid = tg_id
+        elif full_name and full_name != row[1]:
+            uid = row[0]
+            await db.execute("UPDATE users SET full_name=? WHERE id=?", (full_name, uid))
+        else:
+            return row[0]
+    _name_cache.pop(uid, None)
+    _policy_cache.pop(uid, None)
+    _tgid_cache.pop(uid, None)
+    _saldo_cache.pop(uid, None)
+    _users_kb_cache.clear()
+    _log_event("USER_UPSERTED", tg_id=tg_id, name=full_name or "")
+    return uid
 
 async def get_tgid_by_userid(user_id: int) -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT tg_id FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-        return row[0] if row and row[0] is not None else None
+    cached = _cache_get(_tgid_cache, user_id)
+    if cached is not _MISS:
+        return cached
+    db = await get_read_db()
+    cur = await db.execute("SELECT tg_id FROM users WHERE id=?", (user_id,))
+    row = await cur.fetchone()
+    return _cache_put(_tgid_cache, user_id, row[0] if row and row[0] is not None else None)
 
 async def get_user_by_tgid(tg_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, full_name, wallet_kwh FROM users WHERE tg_id=?", (tg_id,))
-        return await cur.fetchone()
+    db = await get_read_db()
+    cur = await db.execute("SELECT id, full_name, wallet_kwh FROM users WHERE tg_id=?", (tg_id,))
+    return await cur.fetchone()
 
 async def get_user_by_id(user_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, full_name, wallet_kwh FROM users WHERE id=?", (user_id,))
-        return await cur.fetchone()
+    db = await get_read_db()
+    cur = await db.execute("SELECT id, full_name, wallet_kwh FROM users WHERE id=?", (user_id,))
+    return await cur.fetchone()
 
 async def _get_user_name(user_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT full_name FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-        return row[0] if row else None
+    cached = _cache_get(_name_cache, user_id)
+    if cached is not _MISS:
+        return cached
+    db = await get_read_db()
+    cur = await db.execute("SELECT full_name FROM users WHERE id=?", (user_id,))
+    row = await cur.fetchone()
+    return _cache_put(_name_cache, user_id, row[0] if row else None)
 
 # ---- Credit Request Functions ----
 
 async def count_user_pending_requests(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COUNT(*) FROM credit_requests WHERE user_id=? AND status='pending'",
-            (user_id,)
-        )
-        row = await cur.fetchone()
-        return row[0] if row else 0
+    db = await get_read_db()
+    cur = await db.execute(
+        "SELECT COUNT(*) FROM credit_requests WHERE user_id=? AND status='pending'",
+        (user_id,)
+    )
+    row = await cur.fetchone()
+    return row[0] if row else 0
 
-async def create_credit_request(user_id: int, slot: str, kwh: float, photo_path: str | None, note: str | None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            INSERT INTO credit_requests (user_id, slot, kwh, photo_path, note, status)
-            VALUES (?, ?, ?, ?, ?, 'pending')
-        """, (user_id, slot, kwh, photo_path, note))
-        await db.commit()
-        return cur.lastrowid
+# Creations are queued to a single writer task that inserts whatever is waiting in one
+# transaction: concurrent uploads share one commit (fsync) instead of paying one each.
+CR_BATCH_MAX = 50
+
+_cr_queue: asyncio.Queue | None = None
+_cr_writer: asyncio.Task | None = None
+_CR_STOP = object()  # queued by stop_credit_request_writer behind the pending items
+
+def _fail_futures(items, exc: BaseException):
+    for item in items:
+        if item is not _CR_STOP and not item[1].done():
+            item[1].set_exception(exc)
+
+async def _credit_request_writer():
+    batch = []
+    stopping = False
+    try:
+        while True:
+            batch = [await _cr_queue.get()]
+            # No waiting window: take only what is already queued, so a lone request isn't delayed
+            while len(batch) < CR_BATCH_MAX and not _cr_queue.empty():
+                batch.append(_cr_queue.get_nowait())
+            if any(item is _CR_STOP for item in batch):
+                stopping = True
+                batch = [item for item in batch if item is not _CR_STOP]
+            if batch:
+                await _write_credit_requests(batch)
+            batch = []
+            # On stop, keep going until whatever was queued (even late) is written
+            if stopping and _cr_queue.empty():
+                return
+    except BaseException as e:
+        # Cancelled or crashed: nobody may be left awaiting a future that never resolves
+        exc = e if isinstance(e, Exception) else RuntimeError("credit request writer stopped")
+        _fail_futures(batch, exc)
+        while not _cr_queue.empty():
+            _fail_futures([_cr_queue.get_nowait()], exc)
+        raise
+
+async def _write_credit_requests(batch):
+    try:
+        async with _write_tx() as db:
+            ids = []
+            for params, _ in batch:
+                # The pending cap is checked in the same statement as the insert, so
+                # concurrent submissions can't race past it; no row back means refused
+                cur = await db.execute("""
+                    INSERT INTO credit_requests (user_id, slot, kwh, photo_path, note, status)
+                    SELECT ?, ?, ?, ?, ?, 'pending'
+                    WHERE (SELECT COUNT(*) FROM credit_requests
+                           WHERE user_id=? AND status='pending') < ?
+                    RETURNING id
+                """, params + (params[0], MAX_PENDING_REQUESTS))
+                row = await cur.fetchone()
+                ids.append(row[0] if row else None)
+    except Exception as e:
+        _fail_futures(batch, e)
+        return
+    for (_, fut), request_id in zip(batch, ids):
+        if not fut.done():
+            fut.set_result(request_id)
+    if len(batch) > 1:
+        _log_event("CR_BATCH_WRITTEN", size=len(batch))
+
+async def stop_credit_request_writer():
+    """Let the writer commit everything already queued, then stop it"""
+    global _cr_queue, _cr_writer
+    if _cr_writer is not None:
+        if not _cr_writer.done():
+            _cr_queue.put_nowait(_CR_STOP)
+        with contextlib.suppress(Exception, asyncio.CancelledError):
+            await _cr_writer
+    _cr_queue = _cr_writer = None
+
+async def create_credit_request(user_id: int, slot: str, kwh: float, photo_path: str | None, note: str | None) -> int | None:
+    """Queue a pending request; returns its id, or None if the user is at MAX_PENDING_REQUESTS"""
+    global _cr_queue, _cr_writer
+    if _cr_writer is None:
+        _cr_queue = asyncio.Queue()
+        _cr_writer = asyncio.create_task(_credit_request_writer())
+    # Validate the photo once here; a stored path is then trusted by every reader
+    held_path = photo_path
+    if photo_path and not Path(photo_path).is_file():
+        log.warning("Credit photo missing, storing request without it: %s", photo_path)
+        photo_path = None
+    fut = asyncio.get_running_loop().create_future()
+    _cr_queue.put_nowait(((user_id, slot, kwh, photo_path, note), fut))
+    request_id = await fut
+    if request_id is not None:
+        # Committed: the row now keeps the file alive; a refusal is released by _remove_photo
+        _release_photo(held_path)
+    return request_id
 
 async def get_credit_request(request_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, user_id, slot, kwh, photo_path, note, status, created_at, processed_at, processed_by
-            FROM credit_requests WHERE id=?
-        """, (request_id,))
-        return await cur.fetchone()
+    db = await get_read_db()
+    # Owner tg_id joined in so approve/reject can notify without another lookup
+    cur = await db.execute("""
+        SELECT cr.id, cr.user_id, cr.slot, cr.kwh, cr.status, u.tg_id
+        FROM credit_requests cr
+        LEFT JOIN users u ON u.id = cr.user_id
+        WHERE cr.id=?
+    """, (request_id,))
+    # Read by column name; the shared connection keeps plain tuples for everything else
+    cur.row_factory = sqlite3.Row
+    return await cur.fetchone()
 
 async def get_pending_requests(user_id: int | None = None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        if user_id is not None:
-            cur = await db.execute("""
-                SELECT id, user_id, slot, kwh, photo_path, note, created_at
-                FROM credit_requests 
-                WHERE user_id=? AND status='pending'
-                ORDER BY created_at DESC
-            """, (user_id,))
-        else:
-            cur = await db.execute("""
-                SELECT id, user_id, slot, kwh, photo_path, note, created_at
-                FROM credit_requests 
-                WHERE status='pending'
-                ORDER BY created_at DESC
-            """)
-        return await cur.fetchall()
+    db = await get_read_db()
+    if user_id is not None:
+        return await db.execute_fetchall("""
+            SELECT id, user_id, slot, kwh, photo_path, note, created_at
+            FROM credit_requests 
+            WHERE user_id=? AND status='pending'
+            ORDER BY created_at DESC
+        """, (user_id,))
+    return await db.execute_fetchall("""
+        SELECT id, user_id, slot, kwh, photo_path, note, created_at
+        FROM credit_requests 
+        WHERE status='pending'
+        ORDER BY created_at DESC
+    """)
+
+async def get_pending_requests_with_user():
+    """All pending requests with the owner's full_name and tg_id joined in (admin listing)"""
+    db = await get_read_db()
+    return await db.execute_fetchall("""
+        SELECT cr.id, cr.user_id, cr.slot, cr.kwh, cr.photo_path, cr.note, cr.created_at,
+               u.full_name, u.tg_id
+        FROM credit_requests cr
+        LEFT JOIN users u ON u.id = cr.user_id
+        WHERE cr.status='pending'
+        ORDER BY cr.created_at DESC
+    """)
 
 async def approve_credit_request(request_id: int, admin_id: int) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db_lock:
+        db = await get_db()
         try:
-            await db.execute("BEGIN")
+            await db.execute("BEGIN IMMEDIATE")
             
-            # Get request details
+            # Request, owner balance and owner's effective negative policy in one read
             cur = await db.execute("""
-                SELECT user_id, kwh, slot, status FROM credit_requests WHERE id=?
-            """, (request_id,))
+                SELECT cr.user_id, cr.kwh, cr.slot, cr.status, u.id, u.wallet_kwh,
+                       COALESCE(u.allow_negative_user, ?)
+                FROM credit_requests cr LEFT JOIN users u ON u.id = cr.user_id
+                WHERE cr.id=?
+            """, (int(ALLOW_NEGATIVE_DEFAULT), request_id))
             row = await cur.fetchone()
             
             if not row:
-                await db.execute("ROLLBACK")
+                await db.rollback()
                 return False, "Richiesta non trovata"
             
-            user_id, kwh, slot, status = row
+            user_id, kwh, slot, status, found, balance, allow_negative = row
             
             if status != 'pending':
-                await db.execute("ROLLBACK")
+                await db.rollback()
                 return False, f"Richiesta già {status}"
-            
-            # Deduct kWh from user balance
-            cur = await db.execute("SELECT wallet_kwh FROM users WHERE id=?", (user_id,))
-            row = await cur.fetchone()
-            if not row:
-                await db.execute("ROLLBACK")
+            if found is None:
+                await db.rollback()
                 return False, "Utente non trovato"
+            if float(balance or 0.0) - kwh < 0 and allow_negative != 1:
+                await db.rollback()
+                return False, "Saldo insufficiente"
             
-            current_balance = float(row[0] or 0.0)
-            new_balance = current_balance - kwh
-            
-            # Check if negative is allowed (simplified - you may want to use the existing policy)
-            if new_balance < 0 and not _env_allow_negative_default():
-                # Check user-specific policy
-                cur = await db.execute("SELECT allow_negative_user FROM users WHERE id=?", (user_id,))
-                row = await cur.fetchone()
-                if row and row[0] != 1:  # If not explicitly allowed
-                    await db.execute("ROLLBACK")
-                    return False, "Saldo insufficiente"
-            
-            # Update user balance
-            await db.execute("UPDATE users SET wallet_kwh=? WHERE id=?", (new_balance, user_id))
+            # Deduct kWh from user balance
+            cur = await db.execute(
+                "UPDATE users SET wallet_kwh = wallet_kwh - ? WHERE id=? RETURNING wallet_kwh + ?, wallet_kwh",
+                (kwh, user_id, kwh)
+            )
+            current_balance, new_balance = await cur.fetchone()
             
             # Record operation
             await db.execute("""
@@ -349,23 +682,25 @@ async def approve_credit_request(request_id: int, admin_id: int) -> tuple[bool,
             """, (admin_id, request_id))
             
             await db.commit()
+            _saldo_cache.pop(user_id, None)
+            _users_kb_cache.clear()
             _log_event("CREDIT_REQUEST_APPROVED", request_id=request_id, user_id=user_id, kwh=kwh, admin=admin_id)
             return True, f"Saldo: {current_balance:.2f} → {new_balance:.2f} kWh"
             
         except Exception as e:
             try:
-                await db.execute("ROLLBACK")
+                await db.rollback()
             except:
                 pass
             log.exception("Error approving credit request: %s", e)
             return False, f"Errore: {str(e)}"
 
 async def reject_credit_request(request_id: int, admin_id: int, reason: str | None = None) -> tuple[bool, str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        try:
+    try:
+        async with _write_tx() as db:
             # Check if request exists and is pending
             cur = await db.execute("""
-                SELECT status FROM credit_requests WHERE id=?
+                SELECT status, user_id FROM credit_requests WHERE id=?
             """, (request_id,))
             row = await cur.fetchone()
             
@@ -382,64 +717,139 @@ async def reject_credit_request(request_id: int, admin_id: int, reason: str | No
                 SET status='rejected', processed_at=datetime('now'), processed_by=?, note=?
                 WHERE id=?
             """, (admin_id, note_field, request_id))
-            
-            await db.commit()
-            _log_event("CREDIT_REQUEST_REJECTED", request_id=request_id, admin=admin_id, reason=reason)
-            return True, "Richiesta rifiutata"
-            
-        except Exception as e:
-            log.exception("Error rejecting credit request: %s", e)
-            return False, f"Errore: {str(e)}"
+        _saldo_cache.pop(row[1], None)
+        _log_event("CREDIT_REQUEST_REJECTED", request_id=request_id, admin=admin_id, reason=reason)
+        return True, "Richiesta rifiutata"
+        
+    except Exception as e:
+        log.exception("Error rejecting credit request: %s", e)
+        return False, f"Errore: {str(e)}"
+
+_tmp_seq = itertools.count()
+
+def _store_photo_sync(data: bytes | bytearray) -> str:
+    # Content-addressed: identical uploads share one file on disk
+    photo_path = os.path.join(CREDIT_PHOTOS_PATH, f"{hashlib.sha256(data).hexdigest()}.jpg")
+    if not os.path.exists(photo_path):
+        # Unique per process and per write: no urandom read needed for a scratch name
+        tmp_path = f"{photo_path}.{os.getpid()}.{next(_tmp_seq)}.tmp"
+        # One write of the whole image: no userspace buffer in between
+        with open(tmp_path, "wb", buffering=0) as f:
+            f.write(data)
+        os.replace(tmp_path, photo_path)
+    return photo_path
+
+# Saved photos not yet referenced by a committed request {path: flows holding it}.
+# A shared (same content) file must survive another flow's cancel until its row exists.
+_photo_holds: dict[str, int] = {}
+
+def _release_photo(photo_path: str | None):
+    n = _photo_holds.get(photo_path, 0) - 1
+    if n > 0:
+        _photo_holds[photo_path] = n
+    else:
+        _photo_holds.pop(photo_path, None)
+
+async def _save_credit_photo(context: ContextTypes.DEFAULT_TYPE, photo) -> str:
+    """Store the photo and hold it until create_credit_request commits it (or _remove_photo)"""
+    file = await context.bot.get_file(photo.file_id)
+    data = await file.download_as_bytearray()
+    photo_path = await asyncio.to_thread(_store_photo_sync, data)
+    _photo_holds[photo_path] = _photo_holds.get(photo_path, 0) + 1
+    # An existing file may have been unlinked before the hold was taken: write it again
+    if not os.path.exists(photo_path):
+        await asyncio.to_thread(_store_photo_sync, data)
+    return photo_path
+
+async def _remove_photo(photo_path: str | None):
+    if not photo_path:
+        return
+    _release_photo(photo_path)
+    if photo_path in _photo_holds:
+        return
+    # The file may be shared with another request that uploaded the same photo
+    db = await get_read_db()
+    cur = await db.execute("SELECT 1 FROM credit_requests WHERE photo_path=? LIMIT 1", (photo_path,))
+    # Re-checked after the await, with no await before the unlink
+    if await cur.fetchone() or photo_path in _photo_holds:
+        return
+    with contextlib.suppress(OSError):
+        os.remove(photo_path)
 
 # ---- Notification Helpers ----
 
+_CR_CAPTION_TMPL = (
+    "🆕 *Nuova richiesta di ricarica*\n\n"
+    "📋 Richiesta #{rid}\n"
+    "👤 Utente: {user} (TG: {tg})\n"
+    "📍 Slot: {slot}\n"
+    "⚡ kWh: *{kwh:g}*\n"
+)
+
+def _cr_kb(request_id: int) -> InlineKeyboardMarkup:
+    rid = str(request_id)
+    return InlineKeyboardMarkup([(
+        InlineKeyboardButton("✅ Approva", callback_data="CR_APPROVE:" + rid),
+        InlineKeyboardButton("❌ Rifiuta", callback_data="CR_REJECT:" + rid),
+    )])
+
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE, request_id: int, user_id: int, slot: str, kwh: float, photo_path: str | None, note: str | None):
     """Send notification to all admins with approve/reject buttons"""
     user_name = await _get_user_name(user_id)
     tg_id = await get_tgid_by_userid(user_id)
-    username = user_name or f"ID {user_id}"
-    
-    message = (
-        f"🆕 *Nuova richiesta di ricarica*\n\n"
-        f"📋 Richiesta #{request_id}\n"
-        f"👤 Utente: {username} (TG: {tg_id})\n"
-        f"📍 Slot: *{slot}*\n"
-        f"⚡ kWh: *{kwh:g}*\n"
-    )
+    username = _md(user_name) if user_name else f"ID {user_id}"
     
+    message = _CR_CAPTION_TMPL.format(rid=request_id, user=username, tg=tg_id, slot=_md(slot), kwh=kwh)
     if note:
-        message += f"📝 Nota: _{note}_\n"
+        message += f"📝 Nota: {_md(note)}\n"
+    keyboard = _cr_kb(request_id)
     
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("✅ Approva", callback_data=f"CR_APPROVE:{request_id}"),
-            InlineKeyboardButton("❌ Rifiuta", callback_data=f"CR_REJECT:{request_id}")
-        ]
-    ])
-    
-    for admin_id in ADMIN_IDS:
+    async def _send(admin_id: int, photo):
         try:
-            # Send photo if available
-            if photo_path and os.path.exists(photo_path):
-                with open(photo_path, 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=admin_id,
-                        photo=photo,
-                        caption=message,
-                        reply_markup=keyboard
-                    )
-            else:
-                await context.bot.send_message(
+            if photo is not None:
+                return await context.bot.send_photo(
                     chat_id=admin_id,
-                    text=message,
+                    photo=photo,
+                    caption=message,
                     reply_markup=keyboard
                 )
+            return await context.bot.send_message(
+                chat_id=admin_id,
+                text=message,
+                reply_markup=keyboard
+            )
         except Exception as e:
             log.warning(f"Failed to notify admin {admin_id}: {e}")
+            return None
+
+    admins = list(ADMIN_IDS)
+    photo = None
+    if photo_path:
+        # Read the file once and upload it a single time: the first admin that receives it
+        # gives us Telegram's file_id, which the others get instead of the bytes
+        try:
+            photo = await asyncio.to_thread(Path(photo_path).read_bytes)
+        except OSError as e:
+            log.warning("Credit photo unreadable, notifying without it: %s", e)
+        while admins and isinstance(photo, bytes):
+            sent = await _send(admins.pop(0), photo)
+            if sent is not None and sent.photo:
+                photo = sent.photo[-1].file_id
+
+    # Fan out: total latency is one round trip, not one per admin
+    await asyncio.gather(*(_send(a, photo) for a in admins))
+
+async def _send_to_user(context: ContextTypes.DEFAULT_TYPE, tg_id: int | None, text: str):
+    """Best-effort message to a wallet owner; failures (blocked bot, no tg_id) are ignored"""
+    if not tg_id:
+        return
+    try:
+        await context.bot.send_message(chat_id=tg_id, text=text)
+    except Exception:
+        pass
 
-async def notify_user_request_result(context: ContextTypes.DEFAULT_TYPE, user_id: int, approved: bool, kwh: float, slot: str, details: str = ""):
+async def notify_user_request_result(context: ContextTypes.DEFAULT_TYPE, tg_id: int | None, approved: bool, kwh: float, slot: str, details: str = ""):
     """Notify user about approval or rejection"""
-    tg_id = await get_tgid_by_userid(user_id)
     if not tg_id:
         return
     
@@ -448,7 +858,7 @@ async def notify_user_request_result(context: ContextTypes.DEFAULT_TYPE, user_id
             message = (
                 f"✅ *Richiesta Approvata*\n\n"
                 f"La tua richiesta di ricarica è stata approvata!\n"
-                f"📍 Slot: {slot}\n"
+                f"📍 Slot: {_md(slot)}\n"
                 f"⚡ kWh scalati: {kwh:g}\n\n"
                 f"{details}"
             )
@@ -456,7 +866,7 @@ async def notify_user_request_result(context: ContextTypes.DEFAULT_TYPE, user_id
             message = (
                 f"❌ *Richiesta Rifiutata*\n\n"
                 f"La tua richiesta di ricarica è stata rifiutata.\n"
-                f"📍 Slot: {slot}\n"
+                f"📍 Slot: {_md(slot)}\n"
                 f"⚡ kWh: {kwh:g}\n\n"
                 f"Contatta un amministratore per maggiori informazioni."
             )
@@ -466,111 +876,184 @@ async def notify_user_request_result(context: ContextTypes.DEFAULT_TYPE, user_id
             text=message
         )
     except Exception as e:
-        log.warning(f"Failed to notify user {user_id}: {e}")
+        log.warning(f"Failed to notify user {tg_id}: {e}")
 
 # ---- Allow negative policy ----
 
 async def get_user_negative_policy(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT allow_negative_user FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-        if not row:
-            return False, "GLOBAL", None, _env_allow_negative_default()
-        user_val = row[0]
-        g = _env_allow_negative_default()
-        if user_val is None:
-            return g, "GLOBAL", None, g
-        return bool(user_val), "USER", bool(user_val), g
+    cached = _cache_get(_policy_cache, user_id)
+    if cached is not _MISS:
+        return cached
+    db = await get_read_db()
+    cur = await db.execute("SELECT allow_negative_user FROM users WHERE id=?", (user_id,))
+    row = await cur.fetchone()
+    g = ALLOW_NEGATIVE_DEFAULT
+    if not row:
+        policy = (False, "GLOBAL", None, g)
+    elif row[0] is None:
+        policy = (g, "GLOBAL", None, g)
+    else:
+        policy = (bool(row[0]), "USER", bool(row[0]), g)
+    return _cache_put(_policy_cache, user_id, policy)
 
 async def set_user_allow_negative(user_id: int, enabled: bool|None) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write_tx() as db:
         if enabled is None:
             cur = await db.execute("UPDATE users SET allow_negative_user=NULL WHERE id=?", (user_id,))
         else:
             cur = await db.execute("UPDATE users SET allow_negative_user=? WHERE id=?", (1 if enabled else 0, user_id))
-        await db.commit()
-        _log_event("ALLOW_NEG_SET", user_id=user_id, value=("DEFAULT" if enabled is None else ("ON" if enabled else "OFF")))
-        return cur.rowcount > 0
+    _policy_cache.pop(user_id, None)
+    _log_event("ALLOW_NEG_SET", user_id=user_id, value=("DEFAULT" if enabled is None else ("ON" if enabled else "OFF")))
+    return cur.rowcount > 0
 
 # ---- Money engine (existing functions) ----
 
+# apply_delta_kwh result: (ok, old_balance, new_balance, full_name, tg_id)
+_DELTA_FAIL = (False, None, None, None, None)
+
 async def apply_delta_kwh(user_id: int, delta: float, reason: str, slot: str|None, admin_id: int|None):
     if not isinstance(delta, (int, float)) or delta == 0:
-        return False, None, None
+        return _DELTA_FAIL
     if abs(delta) > MAX_CREDIT_PER_OP:
-        return False, None, None
+        return _DELTA_FAIL
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    delta = float(delta)
+    async with _db_lock:
+        db = await get_db()
         try:
-            await db.execute("BEGIN")
-            cur = await db.execute("SELECT wallet_kwh, COALESCE(allow_negative_user, -1) FROM users WHERE id=?", (user_id,))
+            await db.execute("BEGIN IMMEDIATE")
+            # Policy, cap and balance update in one statement: no row back means blocked.
+            cur = await db.execute("""
+                UPDATE users SET wallet_kwh = wallet_kwh + :d
+                WHERE id = :u AND wallet_kwh + :d <= :max
+                  AND (wallet_kwh + :d >= 0 OR COALESCE(allow_negative_user, :g) = 1)
+                RETURNING wallet_kwh - :d, wallet_kwh, full_name, tg_id
+            """, {"d": delta, "u": user_id, "max": MAX_WALLET_KWH, "g": int(ALLOW_NEGATIVE_DEFAULT)})
             row = await cur.fetchone()
             if not row:
                 await db.execute("ROLLBACK")
-                return False, None, None
-
-            old_balance = float(row[0] or 0.0)
-            user_flag = int(row[1])
-            allow_neg = _env_allow_negative_default() if user_flag == -1 else (user_flag == 1)
+                return await _explain_blocked_delta(user_id, delta)
 
-            new_balance = old_balance + float(delta)
-
-            if not allow_neg and new_balance < 0:
-                await db.execute("ROLLBACK")
-                _log_event("DELTA_BLOCKED_NEGATIVE", user_id=user_id, delta=delta, old=old_balance, new=new_balance)
-                return False, old_balance, old_balance
-
-            if new_balance > MAX_WALLET_KWH:
-                await db.execute("ROLLBACK")
-                _log_event("DELTA_BLOCKED_MAX", user_id=user_id, delta=delta, old=old_balance, new=new_balance)
-                return False, None, None
-
-            await db.execute("UPDATE users SET wallet_kwh=? WHERE id=?", (new_balance, user_id))
+            old_balance, new_balance = float(row[0]), float(row[1])
+            # Name and tg_id come back with the update: confirm handlers need no extra lookups
+            full_name = _cache_put(_name_cache, user_id, row[2])
+            tg_id = _cache_put(_tgid_cache, user_id, row[3])
             await db.execute("""
                 INSERT INTO kwh_operations (user_id, delta_kwh, reason, slot, admin_id)
                 VALUES (?,?,?,?,?)
-            """, (user_id, float(delta), reason, slot, admin_id))
+            """, (user_id, delta, reason, slot, admin_id))
             await db.commit()
+            _saldo_cache.pop(user_id, None)
+            _users_kb_cache.clear()
             _log_event("DELTA_APPLIED", user_id=user_id, delta=delta, reason=reason, slot=slot, admin=admin_id, old=old_balance, new=new_balance)
-            return True, old_balance, new_balance
+            return True, old_balance, new_balance, full_name, tg_id
 
         except Exception as e:
-            try: await db.execute("ROLLBACK")
+            try: await db.rollback()
             except: pass
             log.exception("ERR apply_delta_kwh: %s", e)
-            return False, None, None
+            return _DELTA_FAIL
+
+async def _explain_blocked_delta(user_id: int, delta: float):
+    """Slow path of apply_delta_kwh: tell apart missing user, negative and max cap."""
+    db = await get_db()
+    cur = await db.execute("SELECT wallet_kwh FROM users WHERE id=?", (user_id,))
+    row = await cur.fetchone()
+    if not row:
+        return _DELTA_FAIL
+    old_balance = float(row[0] or 0.0)
+    new_balance = old_balance + delta
+    if new_balance < 0:
+        _log_event("DELTA_BLOCKED_NEGATIVE", user_id=user_id, delta=delta, old=old_balance, new=new_balance)
+        return False, old_balance, old_balance, None, None
+    _log_event("DELTA_BLOCKED_MAX", user_id=user_id, delta=delta, old=old_balance, new=new_balance)
+    return _DELTA_FAIL
 
 async def accredita_kwh(user_id: int, amount: float, slot: str|None, admin_id: int|None):
     if amount is None or amount <= 0:
-        return False, None, None
+        return _DELTA_FAIL
     return await apply_delta_kwh(user_id, +abs(float(amount)), "admin_credit", slot, admin_id)
 
 async def addebita_kwh(user_id: int, amount: float, slot: str|None, admin_id: int|None):
     if amount is None or amount <= 0:
-        return False, None, None
+        return _DELTA_FAIL
     return await apply_delta_kwh(user_id, -abs(float(amount)), "admin_debit", slot, admin_id)
 
+async def apply_deltas_bulk(items: list[tuple[int, float, str, str|None, int|None]]) -> bool:
+    """Apply many (user_id, delta, reason, slot, admin_id) in one transaction (e.g. CSV import).
+
+    Deltas are summed per user and checked against the same policy/cap as apply_delta_kwh;
+    if any user is blocked the whole batch is rolled back.
+    """
+    if not items:
+        return True
+    totals: dict[int, float] = {}
+    for user_id, delta, *_ in items:
+        if not isinstance(delta, (int, float)) or delta == 0 or abs(delta) > MAX_CREDIT_PER_OP:
+            return False
+        totals[user_id] = totals.get(user_id, 0.0) + float(delta)
+
+    g = int(ALLOW_NEGATIVE_DEFAULT)
+    async with _db_lock:
+        db = await get_db()
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            before = db.total_changes
+            await db.executemany("""
+                UPDATE users SET wallet_kwh = wallet_kwh + :d
+                WHERE id = :u AND wallet_kwh + :d <= :max
+                  AND (wallet_kwh + :d >= 0 OR COALESCE(allow_negative_user, :g) = 1)
+            """, [{"d": d, "u": u, "max": MAX_WALLET_KWH, "g": g} for u, d in totals.items()])
+            if db.total_changes - before != len(totals):
+                await db.execute("ROLLBACK")
+                _log_event("DELTA_BULK_BLOCKED", items=len(items), users=len(totals))
+                return False
+            await db.executemany("""
+                INSERT INTO kwh_operations (user_id, delta_kwh, reason, slot, admin_id)
+                VALUES (?,?,?,?,?)
+            """, [(u, float(d), r, s, a) for u, d, r, s, a in items])
+            await db.commit()
+            for u in totals:
+                _saldo_cache.pop(u, None)
+            _users_kb_cache.clear()
+            _log_event("DELTA_BULK_APPLIED", items=len(items), users=len(totals))
+            return True
+
+        except Exception as e:
+            try: await db.rollback()
+            except: pass
+            log.exception("ERR apply_deltas_bulk: %s", e)
+            return False
+
 # ---- User queries ----
 
 PAGE_SIZE = 10
 
 async def fetch_users_page(page: int = 0):
     offset = max(0, page) * PAGE_SIZE
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, COALESCE(full_name,'Utente') as name, wallet_kwh
-            FROM users ORDER BY name COLLATE NOCASE LIMIT ? OFFSET ?
-        """, (PAGE_SIZE, offset))
-        rows = await cur.fetchall()
-        cur2 = await db.execute("SELECT COUNT(*) FROM users")
-        total = (await cur2.fetchone())[0]
-        return rows, total
+    db = await get_read_db()
+    # Page and total in one statement; COUNT(*) OVER () is computed before LIMIT
+    rows = await db.execute_fetchall("""
+        SELECT id, COALESCE(full_name,'Utente') as name, wallet_kwh, COUNT(*) OVER () AS total
+        FROM users ORDER BY name COLLATE NOCASE LIMIT ? OFFSET ?
+    """, (PAGE_SIZE, offset))
+    if rows:
+        return [r[:3] for r in rows], rows[0][3]
+    # Past the last page there is no row to carry the total
+    cur2 = await db.execute("SELECT COUNT(*) FROM users")
+    return [], (await cur2.fetchone())[0]
+
+# Static keyboard rows, shared by every page/search render (PTB markup is immutable once built)
+_SEARCH_ROW = (InlineKeyboardButton("🔎 Cerca utente", callback_data="AC_FIND"),)
+_BACK_TO_LIST_ROW = (InlineKeyboardButton("↩️ Torna all'elenco", callback_data="AC_START"),)
+_ROW_FMT = "{0} (id {1}) — {2:.2f} kWh".format
+
+def _user_rows(rows):
+    return [(InlineKeyboardButton(_ROW_FMT(name, uid, bal), callback_data="ACU:" + str(uid)),) for uid, name, bal in rows]
 
 def build_users_kb(rows, page, total):
-    buttons = [[InlineKeyboardButton("🔎 Cerca utente", callback_data="AC_FIND")]]
-    for uid, name, bal in rows:
-        label = f"{name} (id {uid}) — {bal:.2f} kWh"
-        buttons.append([InlineKeyboardButton(label, callback_data=f"ACU:{uid}")])
+    buttons = [_SEARCH_ROW]
+    buttons.extend(_user_rows(rows))
     nav = []
     if page > 0:
         nav.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"ACP:{page-1}"))
@@ -580,71 +1063,126 @@ def build_users_kb(rows, page, total):
         buttons.append(nav)
     return InlineKeyboardMarkup(buttons)
 
+async def users_page_kb(page: int) -> tuple[InlineKeyboardMarkup, int]:
+    cached = _cache_get(_users_kb_cache, page)
+    if cached is not _MISS:
+        return cached
+    rows, total = await fetch_users_page(page)
+    return _cache_put(_users_kb_cache, page, (build_users_kb(rows, page, total), total))
+
+_FTS_TOKEN_RE = re.compile(r"\w+")
+
 async def search_users_by_name(q: str, limit: int = 20):
-    like = f"%{q.strip()}%"
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, COALESCE(full_name,'Utente') as name, wallet_kwh
-            FROM users WHERE COALESCE(full_name,'') LIKE ? COLLATE NOCASE
-            ORDER BY name LIMIT ?
-        """, (like, limit))
-        return await cur.fetchall()
+    db = await get_read_db()
+    # Token-prefix match through FTS5; each token quoted so user input is never FTS syntax
+    tokens = _FTS_TOKEN_RE.findall(q)
+    if tokens:
+        try:
+            rows = await db.execute_fetchall("""
+                SELECT u.id, u.full_name, u.wallet_kwh
+                FROM users_fts f JOIN users u ON u.id = f.rowid
+                WHERE users_fts MATCH ?
+                ORDER BY u.full_name COLLATE NOCASE LIMIT ?
+            """, (" ".join(f'"{t}"*' for t in tokens), limit))
+            if rows:
+                return rows
+        except aiosqlite.OperationalError:
+            pass
+    # Fallback for mid-word fragments, punctuation-only queries or builds without FTS5
+    # Escape LIKE metacharacters so '%' / '_' in the query match literally
+    esc = q.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    # Prefix matches first (range seek on idx_users_name_nocase), then substring matches
+    return await db.execute_fetchall("""
+        SELECT id, name, wallet_kwh FROM (
+            SELECT 0 AS rank, id, full_name AS name, wallet_kwh FROM users
+            WHERE full_name LIKE :prefix ESCAPE '\\'
+            UNION ALL
+            SELECT 1, id, full_name, wallet_kwh FROM users
+            WHERE full_name LIKE :inner ESCAPE '\\' AND full_name NOT LIKE :prefix ESCAPE '\\'
+        ) ORDER BY rank, name COLLATE NOCASE LIMIT :limit
+    """, {"prefix": esc + "%", "inner": "%" + esc + "%", "limit": limit})
 
 def build_search_kb(rows, query):
-    buttons = []
-    for uid, name, bal in rows:
-        buttons.append([InlineKeyboardButton(f"{name} (id {uid}) — {bal:.2f} kWh", callback_data=f"ACU:{uid}")])
-    buttons.append([InlineKeyboardButton("↩️ Torna all'elenco", callback_data="AC_START")])
+    buttons = _user_rows(rows)
+    buttons.append(_BACK_TO_LIST_ROW)
     return InlineKeyboardMarkup(buttons)
 
 async def fetch_user_ops(user_id: int, limit: int = 10):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT created_at, delta_kwh, reason, slot, admin_id
-            FROM kwh_operations WHERE user_id=? ORDER BY id DESC LIMIT ?
-        """, (user_id, limit))
-        return await cur.fetchall()
+    db = await get_read_db()
+    return await db.execute_fetchall("""
+        SELECT created_at, delta_kwh, reason, slot, admin_id
+        FROM kwh_operations WHERE user_id=? ORDER BY id DESC LIMIT ?
+    """, (user_id, limit))
 
 # ---- Date parsing ----
 
+def _format_ops(rows) -> str:
+    """One line per (created_at, delta, reason, slot, admin_id) row, built in a single join"""
+    return "\n".join(
+        f"{created_at} — {'➕' if delta >= 0 else '➖'}{abs(delta):g} kWh • {_md(reason)}{f' (slot {_md(slot)})' if slot else ''}"
+        for created_at, delta, reason, slot, _admin_id in rows
+    )
+
+@functools.lru_cache(maxsize=128)
+def _split_italian_date(s: str) -> tuple[int, int, int | None] | None:
+    # gg/mm or gg/mm/aaaa parsed by hand; strptime is far slower for a fixed layout.
+    # The year stays None when omitted so cached entries don't go stale at New Year
+    # Same shapes strptime("%d/%m/%Y") takes: ASCII digits, 1-2 for day/month, exactly 4 for the year
+    parts = s.strip().split("/")
+    if len(parts) not in (2, 3) or not all(p.isascii() and p.isdigit() for p in parts):
+        return None
+    if len(parts[0]) > 2 or len(parts[1]) > 2 or (len(parts) == 3 and len(parts[2]) != 4):
+        return None
+    return int(parts[0]), int(parts[1]), int(parts[2]) if len(parts) == 3 else None
+
 def parse_italian_date(s: str) -> datetime:
-    s = s.strip()
-    today = datetime.now(TZ)
-    for fmt in ("%d/%m/%Y", "%d/%m"):
+    parts = _split_italian_date(s)
+    if parts:
+        day, month, year = parts
         try:
-            dt = datetime.strptime(s, fmt).replace(tzinfo=TZ)
-            if fmt == "%d/%m":
-                dt = dt.replace(year=today.year)
-            return dt
+            return datetime(year or datetime.now(TZ).year, month, day, tzinfo=TZ)
         except ValueError:
             pass
     raise ValueError("Formato data non valido. Usa gg/mm o gg/mm/aaaa")
 
-async def fetch_ops_filtered(user_id: int|None, date_from: datetime|None, date_to: datetime|None, limit: int|None=None):
-    where = []
+# One statement per filter combination (bit 0 user, bit 1 from, bit 2 to): constant SQL text
+# per shape keeps the prepared-statement cache warm; LIMIT -1 means no limit
+_OPS_FILTER_CLAUSES = ("user_id = ?", "created_at >= ?", "created_at < ?")
+def _ops_sql(mask: int) -> str:
+    where = [c for bit, c in enumerate(_OPS_FILTER_CLAUSES) if mask >> bit & 1]
+    sql = "SELECT id,user_id,delta_kwh,reason,slot,admin_id,created_at FROM kwh_operations"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY id DESC LIMIT ?"
+
+_OPS_SQL = {mask: _ops_sql(mask) for mask in range(8)}
+
+OPS_EXPORT_CHUNK = 500
+
+async def iter_ops_filtered(user_id: int|None, date_from: datetime|None, date_to: datetime|None, limit: int|None=None):
+    """Stream matching operations (newest first) in chunks of up to OPS_EXPORT_CHUNK rows"""
+    mask = 0
     params = []
     if user_id is not None:
-        where.append("user_id = ?")
+        mask |= 1
         params.append(user_id)
+    # Bounds are assembled straight from the date fields: created_at has no tz, whole days only
     if date_from is not None:
-        where.append("datetime(created_at) >= datetime(?)")
-        params.append(date_from.strftime("%Y-%m-%d %H:%M:%S"))
+        mask |= 2
+        params.append(f"{date_from.year:04d}-{date_from.month:02d}-{date_from.day:02d} 00:00:00")
     if date_to is not None:
-        where.append("datetime(created_at) < datetime(?)")
-        next_day = (date_to + timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-        params.append(next_day)
-
-    sql = "SELECT id,user_id,delta_kwh,reason,slot,admin_id,created_at FROM kwh_operations"
-    if where:
-        sql += " WHERE " + " AND ".join(where)
-    sql += " ORDER BY id DESC"
-    if limit:
-        sql += f" LIMIT {int(limit)}"
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(sql, tuple(params))
-        rows = await cur.fetchall()
-        return rows
+        # Half-open upper bound (start of the next day): no dependence on seconds precision
+        end = date_to + timedelta(days=1)
+        mask |= 4
+        params.append(f"{end.year:04d}-{end.month:02d}-{end.day:02d} 00:00:00")
+    params.append(limit or -1)
+
+    # Own connection: a long export must not share cursors with the handlers' connection
+    async with _connect() as db:
+        async with db.execute(_OPS_SQL[mask], params) as cur:
+            # One hop to the aiosqlite worker thread per chunk instead of per row
+            while rows := await cur.fetchmany(OPS_EXPORT_CHUNK):
+                yield rows
 
 # ---- Inline admin UI ----
 
@@ -667,6 +1205,55 @@ def admin_home_kb():
         [InlineKeyboardButton("➖ Addebita", callback_data="AD_START")],
     ])
 
+_ADMIN_HOME_KB = admin_home_kb()
+
+def _build_slot_kb(prefix: str) -> InlineKeyboardMarkup:
+    # Up to 6 slots in two rows of 3, then "Salta"
+    kb_rows = [[InlineKeyboardButton(slot.title(), callback_data=f"{prefix}:{slot}") for slot in SLOTS[:3]]]
+    if SLOTS[3:6]:
+        kb_rows.append([InlineKeyboardButton(slot.title(), callback_data=f"{prefix}:{slot}") for slot in SLOTS[3:6]])
+    kb_rows.append([InlineKeyboardButton("Salta", callback_data=f"{prefix}:-")])
+    return InlineKeyboardMarkup(kb_rows)
+
+def _confirm_kb(prefix: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Conferma", callback_data=f"{prefix}:OK"),
+         InlineKeyboardButton("❌ Annulla",  callback_data=f"{prefix}:NO")]
+    ])
+
+# SLOTS is fixed at import, so these never change: build once, reuse on every step
+_ACS_KB = _build_slot_kb("ACS")
+_ADS_KB = _build_slot_kb("ADS")
+_AC_CONFIRM_KB = _confirm_kb("ACC")
+_AD_CONFIRM_KB = _confirm_kb("ADD")
+_CR_CONFIRM_KB = _confirm_kb("CRC")
+
+def _cr_slot_kb() -> InlineKeyboardMarkup:
+    # Credit request: every slot, 3 per row (no "Salta": a request always names its slot)
+    rows = [[InlineKeyboardButton(slot.title(), callback_data=f"CRS:{slot}") for slot in SLOTS[i:i+3]]
+            for i in range(0, len(SLOTS), 3)]
+    return InlineKeyboardMarkup(rows or [[InlineKeyboardButton("Wallet", callback_data="CRS:wallet")]])
+
+_CR_SLOT_KB = _cr_slot_kb()
+
+# ---- Callback patterns ----
+# Compiled once and handed to the handlers as re.Pattern objects
+
+_PAT_AC_START = re.compile(r"^AC_START$")
+_PAT_AD_START = re.compile(r"^AD_START$")
+_PAT_ACU = re.compile(r"^ACU:")
+_PAT_ACU_ADU = re.compile(r"^(ACU|ADU):")
+_PAT_ACP = re.compile(r"^ACP:\d+$")
+_PAT_AC_FIND = re.compile(r"^AC_FIND$")
+_PAT_ACH = re.compile(r"^ACH:\d+$")
+_PAT_ACS = re.compile(r"^ACS:")
+_PAT_ADS = re.compile(r"^ADS:")
+_PAT_ACC = re.compile(r"^ACC:(OK|NO)$")
+_PAT_ADD = re.compile(r"^ADD:(OK|NO)$")
+_PAT_CRS = re.compile(r"^CRS:")
+_PAT_CRN_SKIP = re.compile(r"^CRN:skip$")
+_PAT_CRC = re.compile(r"^CRC:(OK|NO)$")
+
 # ---- Conversation States ----
 
 class ACState(IntEnum):
@@ -690,17 +1277,45 @@ class CRState(IntEnum):  # Credit Request (User flow)
     ASK_NOTE    = 23
     CONFIRM     = 24
 
+@dataclass(slots=True)
+class FlowState:  # AC/AD data kept in user_data between steps
+    user_id: int = 0
+    amount: float = 0.0
+    slot: str | None = None
+
 # ====================
 # COMMANDS
 # ====================
 
+# /start texts only depend on constants: built once at import
+_START_ADMIN_MSG = (
+    f"👋 *Admin* — saldo-bot v{__VERSION__}\n\n"
+    "🔧 *Pannello Amministrazione*\n\n"
+    "📋 *Comandi disponibili:*\n"
+    "• /pending — visualizza richieste in attesa\n"
+    "• /saldo \\[user\\_id] — controlla saldo utente\n"
+    "• /ricarica — invia richiesta di ricarica\n"
+    "• /storico — visualizza storico operazioni\n"
+    "• /export\\_ops — esporta operazioni CSV\n"
+    "• /addebita <user\\_id> <kwh> \\[slot] — addebito manuale\n"
+    "• /allow\\_negative <user\\_id> on|off|default\n\n"
+    f"DB: `{DB_PATH}`"
+)
+_START_USER_MSG = (
+    f"👋 Ciao! Questo è *saldo-bot* v{__VERSION__}\n\n"
+    "💡 *Comandi disponibili:*\n"
+    "• /saldo — visualizza il tuo saldo\n"
+    "• /ricarica — invia richiesta di ricarica\n"
+    "• /storico — visualizza storico\n"
+    "• /pending — visualizza tue richieste in attesa\n\n"
+    "📸 *Puoi anche inviare una foto* con didascalia nel formato:\n"
+    "`slot3 4.5` o `slot8 10 nota opzionale`\n\n"
+    "Per assistenza contatta un amministratore."
+)
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command with different messages for admin vs users"""
-    try:
-        await init_db()
-    except Exception as e:
-        log.exception("INIT_DB_FAILED: %s", e)
-
+    # Schema setup runs once in post_init, not per /start
     user = update.effective_user
     chat = update.effective_chat
     try:
@@ -711,34 +1326,10 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     _log_event("CMD_START", tg_id=(user.id if user else None), name=(getattr(user, "full_name", None)))
 
-    if user and (user.id in ADMIN_IDS):
-        msg = (
-            f"👋 *Admin* — saldo-bot v{__VERSION__}\n\n"
-            "🔧 *Pannello Amministrazione*\n\n"
-            "📋 *Comandi disponibili:*\n"
-            "• /pending — visualizza richieste in attesa\n"
-            "• /saldo [user_id] — controlla saldo utente\n"
-            "• /ricarica — invia richiesta di ricarica\n"
-            "• /storico — visualizza storico operazioni\n"
-            "• /export_ops — esporta operazioni CSV\n"
-            "• /addebita <user_id> <kwh> [slot] — addebito manuale\n"
-            "• /allow_negative <user_id> on|off|default\n\n"
-            f"DB: `{DB_PATH}`"
-        )
-        kb = admin_home_kb()
+    if user and _is_admin(user.id):
+        msg, kb = _START_ADMIN_MSG, _ADMIN_HOME_KB
     else:
-        msg = (
-            f"👋 Ciao! Questo è *saldo-bot* v{__VERSION__}\n\n"
-            "💡 *Comandi disponibili:*\n"
-            "• /saldo — visualizza il tuo saldo\n"
-            "• /ricarica — invia richiesta di ricarica\n"
-            "• /storico — visualizza storico\n"
-            "• /pending — visualizza tue richieste in attesa\n\n"
-            "📸 *Puoi anche inviare una foto* con didascalia nel formato:\n"
-            "`slot3 4.5` o `slot8 10 nota opzionale`\n\n"
-            "Per assistenza contatta un amministratore."
-        )
-        kb = None
+        msg, kb = _START_USER_MSG, None
 
     try:
         if chat:
@@ -750,18 +1341,20 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Quick health check command."""
-    try:
-        await update.effective_message.reply_text("pong 🏓")
-    except Exception:
-        chat = update.effective_chat
-        if chat:
-            await context.bot.send_message(chat_id=chat.id, text="pong 🏓")
+    # Send failures surface in the global error handler; no fallback path needed
+    msg = update.effective_message
+    if msg:
+        await msg.reply_text("pong 🏓")
+
+@functools.lru_cache(maxsize=64)
+def _separator(width: int) -> str:
+    return "─" * width
 
 async def cmd_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check balance - users check own, admins can check any user"""
     caller = update.effective_user.id
     await ensure_user(caller, update.effective_user.full_name)
-    _log_event("CMD_SALDO", caller=caller, args=" ".join(context.args or []))
+    _log_event("CMD_SALDO", caller=caller, args=context.args or ())
     args = context.args
     target_user_id = None
 
@@ -769,7 +1362,7 @@ async def cmd_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             target_user_id = int(args[0])
         except Exception:
-            await update.message.reply_text("Uso admin: /saldo <user_id>")
+            await update.message.reply_text("Uso admin: /saldo <user\\_id>")
             return
 
     if target_user_id is None:
@@ -785,19 +1378,21 @@ async def cmd_saldo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         user_id, full_name, balance = row
 
-    ops = await fetch_user_ops(user_id, 5)
-
-    title = f"💡 Saldo kWh — {full_name or user_id}"
-    lines = [title, "─" * len(title), f"💰 Saldo attuale: *{balance:.2f} kWh*", ""]
-    if ops:
-        lines.append("📋 *Ultime operazioni:*")
-        for (created_at, delta, reason, slot, admin_id) in ops:
-            sign = "➕" if delta >= 0 else "➖"
-            sslot = f" (slot {slot})" if slot else ""
-            lines.append(f"{created_at} — {sign}{abs(delta):g} kWh • {reason}{sslot}")
+    hit = _cache_get(_saldo_cache, user_id)
+    if hit is not _MISS and hit[:2] == (full_name, balance):
+        text = hit[2]
     else:
-        lines.append("Nessuna operazione recente.")
-    await update.message.reply_text("\n".join(lines))
+        ops = await fetch_user_ops(user_id, 5)
+        title = f"💡 Saldo kWh — {full_name or user_id}"
+        lines = [f"💡 Saldo kWh — {_md(full_name or user_id)}", _separator(len(title)), f"💰 Saldo attuale: *{balance:.2f} kWh*", ""]
+        if ops:
+            lines.append("📋 *Ultime operazioni:*")
+            lines.append(_format_ops(ops))
+        else:
+            lines.append("Nessuna operazione recente.")
+        text = "\n".join(lines)
+        _cache_put(_saldo_cache, user_id, (full_name, balance, text))
+    await update.message.reply_text(text)
 
 async def cmd_storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user operation history"""
@@ -813,12 +1408,21 @@ async def cmd_storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not rows:
         await update.message.reply_text("Nessuna operazione registrata.")
         return
-    msg = ["📜 *Ultime 10 operazioni*",""]
-    for created_at, delta, reason, slot, admin_id in rows:
-        sign = "➕" if delta >= 0 else "➖"
-        sslot = f" (slot {slot})" if slot else ""
-        msg.append(f"{created_at} — {sign}{abs(delta):g} kWh • {reason}{sslot}")
-    await update.message.reply_text("\n".join(msg))
+    await update.message.reply_text(f"📜 *Ultime 10 operazioni*\n\n{_format_ops(rows)}")
+
+_PEND_ADMIN_TMPL = (
+    "🔸 *Richiesta #{rid}*\n"
+    "👤 {name} (TG: {tg})\n"
+    "📍 Slot: {slot} | ⚡ {kwh:g} kWh\n"
+    "📅 {ts}\n"
+    "{note_line}\n"
+)
+_PEND_USER_TMPL = (
+    "🔸 *Richiesta #{rid}*\n"
+    "📍 Slot: {slot} | ⚡ {kwh:g} kWh\n"
+    "📅 {ts}\n"
+    "{note_line}\n"
+)
 
 async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show pending credit requests - admin sees all, users see only their own"""
@@ -829,37 +1433,31 @@ async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_admin = _is_admin(caller)
     
     if is_admin:
-        # Admin sees all pending requests
-        requests = await get_pending_requests()
+        # Admin sees all pending requests, owner name and tg_id included
+        requests = await get_pending_requests_with_user()
         if not requests:
             await update.message.reply_text("📭 Nessuna richiesta in attesa.")
             return
         
         lines = ["📥 *Tutte le richieste in attesa*\n"]
-        for req in requests:
-            req_id, user_id, slot, kwh, photo_path, note, created_at = req
-            user_name = await _get_user_name(user_id)
-            tg_id = await get_tgid_by_userid(user_id)
-            lines.append(
-                f"🔸 *Richiesta #{req_id}*\n"
-                f"👤 {user_name or f'User {user_id}'} (TG: {tg_id})\n"
-                f"📍 Slot: {slot} | ⚡ {kwh:g} kWh\n"
-                f"📅 {created_at}\n"
-                f"{'📝 ' + note if note else ''}\n"
+        lines.extend(
+            _PEND_ADMIN_TMPL.format(
+                rid=req_id, name=_md(user_name) if user_name else f"User {user_id}", tg=tg_id,
+                slot=_md(slot), kwh=kwh, ts=created_at, note_line=f"📝 {_md(note)}" if note else "",
             )
+            for req_id, user_id, slot, kwh, _, note, created_at, user_name, tg_id in requests
+        )
         
         msg = "\n".join(lines)
         
         # Add action buttons if there are requests
         if len(requests) > 0:
-            keyboard = []
-            for req in requests[:5]:  # Show buttons for first 5
-                req_id = req[0]
-                keyboard.append([
-                    InlineKeyboardButton(f"✅ Approva #{req_id}", callback_data=f"CR_APPROVE:{req_id}"),
-                    InlineKeyboardButton(f"❌ Rifiuta #{req_id}", callback_data=f"CR_REJECT:{req_id}")
-                ])
-            markup = InlineKeyboardMarkup(keyboard)
+            # Show buttons for first 5; rows are built in one comprehension of tuples
+            markup = InlineKeyboardMarkup([
+                (InlineKeyboardButton("✅ Approva #" + rid, callback_data="CR_APPROVE:" + rid),
+                 InlineKeyboardButton("❌ Rifiuta #" + rid, callback_data="CR_REJECT:" + rid))
+                for rid in (str(req[0]) for req in requests[:5])
+            ])
             await update.message.reply_text(msg, reply_markup=markup)
         else:
             await update.message.reply_text(msg)
@@ -877,38 +1475,37 @@ async def cmd_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         lines = ["📥 *Le tue richieste in attesa*\n"]
-        for req in requests:
-            req_id, _, slot, kwh, photo_path, note, created_at = req
-            lines.append(
-                f"🔸 *Richiesta #{req_id}*\n"
-                f"📍 Slot: {slot} | ⚡ {kwh:g} kWh\n"
-                f"📅 {created_at}\n"
-                f"{'📝 ' + note if note else ''}\n"
+        lines.extend(
+            _PEND_USER_TMPL.format(
+                rid=req_id, slot=_md(slot), kwh=kwh, ts=created_at,
+                note_line=f"📝 {_md(note)}" if note else "",
             )
+            for req_id, _, slot, kwh, _, note, created_at in requests
+        )
         
         await update.message.reply_text("\n".join(lines))
 
+@admin_only
 async def cmd_export_ops(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Export operations to CSV (admin only)"""
     caller = update.effective_user.id
-    _log_event("CMD_EXPORT_OPS", caller=caller, args=" ".join(context.args or []))
-    if not _is_admin(caller):
-        await update.message.reply_text("Comando riservato agli admin.")
-        return
+    _log_event("CMD_EXPORT_OPS", caller=caller, args=context.args or ())
 
     args = context.args
     q_user = None
     d_from = None
     d_to   = None
 
-    for tok in list(args):
-        if tok.lower().startswith("user:"):
+    # One pass over the args: user filter and date tokens
+    date_tokens = []
+    for tok in args:
+        if tok[:5].lower() == "user:":
             try:
-                q_user = int(tok.split(":",1)[1])
-            except Exception:
+                q_user = int(tok[5:])
+            except ValueError:
                 pass
-
-    date_tokens = [t for t in args if "/" in t]
+        elif "/" in tok:
+            date_tokens.append(tok)
     try:
         if len(date_tokens) >= 1:
             d_from = parse_italian_date(date_tokens[0])
@@ -921,18 +1518,23 @@ async def cmd_export_ops(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     limit = None if (q_user or d_from or d_to) else 5000
-    rows = await fetch_ops_filtered(q_user, d_from, d_to, limit=limit)
-    if not rows:
+    # Encode straight into the upload buffer: no intermediate str copy of the whole CSV
+    bio = io.BytesIO()
+    tw = io.TextIOWrapper(bio, encoding="utf-8-sig", newline="")
+    cw = csv.writer(tw)
+    cw.writerow(["id","user_id","delta_kwh","reason","slot","admin_id","created_at"])
+    count = 0
+    async for rows in iter_ops_filtered(q_user, d_from, d_to, limit=limit):
+        # writerows loops in C over the whole chunk
+        cw.writerows((r[0], r[1], float(r[2]), r[3] or "", r[4] or "", r[5] or "", r[6]) for r in rows)
+        count += len(rows)
+    if not count:
         await update.message.reply_text("Nessuna operazione trovata con i filtri indicati.")
         return
-
-    sio = io.StringIO()
-    cw = csv.writer(sio)
-    cw.writerow(["id","user_id","delta_kwh","reason","slot","admin_id","created_at"])
-    for (id_, user_id, delta, reason, slot, admin_id, created_at) in rows:
-        cw.writerow([id_, user_id, float(delta), reason or "", slot or "", admin_id or "", created_at])
-    data = sio.getvalue().encode("utf-8-sig")
-    bio = io.BytesIO(data)
+    # detach() so the wrapper going away does not close the buffer
+    tw.flush()
+    tw.detach()
+    bio.seek(0)
     bio.name = "kwh_operations.csv"
 
     cap = "Esportazione operazioni"
@@ -942,15 +1544,13 @@ async def cmd_export_ops(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_document(document=bio, caption=cap)
 
+@admin_only
 async def cmd_addebita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manual debit command (admin only)"""
     caller = update.effective_user.id
-    _log_event("CMD_ADDEBITA", caller=caller, args=" ".join(context.args or []))
-    if not _is_admin(caller):
-        await update.message.reply_text("Comando riservato agli admin.")
-        return
+    _log_event("CMD_ADDEBITA", caller=caller, args=context.args or ())
     if len(context.args) < 2:
-        await update.message.reply_text("Uso: /addebita <user_id> <kwh> [slot]")
+        await update.message.reply_text("Uso: /addebita <user\\_id> <kwh> \\[slot]")
         return
     try:
         uid = int(context.args[0])
@@ -963,7 +1563,7 @@ async def cmd_addebita(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("La quantità deve essere > 0.")
         return
 
-    ok, old_bal, new_bal = await addebita_kwh(uid, amount, slot, caller)
+    ok, old_bal, new_bal, name, _ = await addebita_kwh(uid, amount, slot, caller)
     if not ok:
         if old_bal is not None and new_bal is not None and old_bal == new_bal and (old_bal - amount) < 0:
             await update.message.reply_text("❗ Saldo insufficiente e negativo non consentito per questo utente.")
@@ -971,25 +1571,22 @@ async def cmd_addebita(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❗ Errore: limiti o saldo insufficiente.")
         return
 
-    name = await _get_user_name(uid)
     await update.message.reply_text(
-        f"✅ Addebitati {amount:g} kWh a {name or uid}\nSaldo: {old_bal:.2f} → {new_bal:.2f} kWh"
+        f"✅ Addebitati {amount:g} kWh a {_md(name or uid)}\nSaldo: {old_bal:.2f} → {new_bal:.2f} kWh"
     )
 
+@admin_only
 async def cmd_allow_negative(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Allow negative balance command (admin only)"""
     caller = update.effective_user.id
-    _log_event("CMD_ALLOW_NEG", caller=caller, args=" ".join(context.args or []))
-    if not _is_admin(caller):
-        await update.message.reply_text("Comando riservato agli admin.")
-        return
+    _log_event("CMD_ALLOW_NEG", caller=caller, args=context.args or ())
     if len(context.args) != 2:
-        await update.message.reply_text("Uso: /allow_negative <user_id> on|off|default")
+        await update.message.reply_text("Uso: /allow\\_negative <user\\_id> on|off|default")
         return
     try:
         uid = int(context.args[0])
     except Exception:
-        await update.message.reply_text("user_id non valido.")
+        await update.message.reply_text("user\\_id non valido.")
         return
 
     mode = context.args[1].lower()
@@ -1011,175 +1608,159 @@ async def cmd_allow_negative(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 # ====================
-# ADMIN CREDIT FLOW (AC) - Existing admin functions
+# ADMIN CREDIT/DEBIT FLOWS (AC/AD) - Existing admin functions
 # ====================
 
-async def on_ac_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        await q.edit_message_text("Funzione riservata agli admin.")
-        return ConversationHandler.END
-    context.user_data['ac'] = {}
-    rows, total = await fetch_users_page(0)
-    _log_event("AC_START", admin=q.from_user.id, page=0, total=total)
-    await q.edit_message_text(
-        "Seleziona l'utente da accreditare:",
-        reply_markup=build_users_kb(rows, 0, total)
-    )
-    return ACState.SELECT_USER
-
-async def on_ac_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    page = int(q.data.split(":",1)[1])
-    rows, total = await fetch_users_page(page)
-    _log_event("AC_PAGE", admin=q.from_user.id, page=page, total=total)
-    await q.edit_message_reply_markup(reply_markup=build_users_kb(rows, page, total))
-    return ACState.SELECT_USER
-
-async def on_ac_find_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    await q.edit_message_text("Scrivi una parte del nome/cognome da cercare:")
-    return ACState.FIND_USER
-
-async def on_ac_find_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    qtxt = (update.message.text or "").strip()
-    if len(qtxt) < 2:
-        await update.message.reply_text("Inserisci almeno 2 caratteri.")
-        return ACState.FIND_USER
-    rows = await search_users_by_name(qtxt)
-    _log_event("AC_FIND", query=qtxt, results=len(rows))
-    if not rows:
-        await update.message.reply_text("Nessun risultato. Riprova.")
-        return ACState.FIND_USER
-    await update.message.reply_text(
-        f'Risultati per "{qtxt}":',
-        reply_markup=build_search_kb(rows, qtxt)
-    )
-    return ACState.SELECT_USER
-
-async def on_ac_pick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    if not q.data.startswith("ACU:"):
-        return ConversationHandler.END
-    uid = int(q.data.split(":",1)[1])
-    context.user_data.setdefault('ac', {})['user_id'] = uid
-    _log_event("AC_PICK_USER", admin=q.from_user.id, user_id=uid)
-
-    kb = InlineKeyboardMarkup([[InlineKeyboardButton("📜 Storico ultime 10", callback_data=f"ACH:{uid}")]])
-    await q.edit_message_text("✏️ Inserisci i kWh da accreditare (es. 10 o 15,345):")
-    await q.edit_message_reply_markup(reply_markup=kb)
-    return ACState.ASK_AMOUNT
-
-async def on_ac_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = (update.message.text or "").strip()
-    if not _is_number(txt):
-        await update.message.reply_text("⚠️ Inserisci i kWh ricaricati (es. 10 o 15,345).")
-        return ACState.ASK_AMOUNT
-
-    amount = round(float(txt.replace(",", ".")), 3)
-    if amount <= 0:
-        await update.message.reply_text("⚠️ Il valore deve essere maggiore di zero.")
-        return ACState.ASK_AMOUNT
-    if amount > MAX_CREDIT_PER_OP:
-        await update.message.reply_text(f"L'importo massimo per singola operazione è {MAX_CREDIT_PER_OP:g} kWh.")
-        return ACState.ASK_AMOUNT
-
-    context.user_data['ac']['amount'] = amount
-    _log_event("AC_AMOUNT_SET", amount=amount)
-    
-    # Build slot buttons dynamically from SLOTS env
-    slot_buttons = []
-    for slot in SLOTS[:3]:  # First 3 in a row
-        slot_buttons.append(InlineKeyboardButton(slot.title(), callback_data=f"ACS:{slot}"))
-    
-    kb_rows = [slot_buttons]
-    if len(SLOTS) > 3:
-        more_buttons = []
-        for slot in SLOTS[3:6]:  # Next 3 in another row
-            more_buttons.append(InlineKeyboardButton(slot.title(), callback_data=f"ACS:{slot}"))
-        if more_buttons:
-            kb_rows.append(more_buttons)
-    
-    kb_rows.append([InlineKeyboardButton("Salta", callback_data="ACS:-")])
-    kb = InlineKeyboardMarkup(kb_rows)
-    
-    await update.message.reply_text(
-        f"Ok, accredito **{amount:g} kWh**.\nVuoi indicare lo slot?",
-        reply_markup=kb
-    )
-    return ACState.ASK_SLOT
+def _make_wallet_flow(key: str, states, apply_fn, slot_kb, confirm_kb, *, verb: str, noun: str,
+                      title: str, notice: str, pick_kb=None, debit: bool = False):
+    """Build the AC or AD conversation handlers; the two flows differ only in texts,
+    states, the user_data key and the wallet operation they apply."""
+    evt = key.upper()
+    op_evt = "DEBIT" if debit else "CREDIT"
+
+    @admin_only
+    async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        context.user_data[key] = FlowState()
+        kb, total = await users_page_kb(0)
+        _log_event(f"{evt}_START", admin=q.from_user.id, page=0, total=total)
+        await q.edit_message_text(f"Seleziona l'utente da {verb}:", reply_markup=kb)
+        return states.SELECT_USER
+
+    @admin_only
+    async def users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        page = int(q.data.split(":",1)[1])
+        kb, total = await users_page_kb(page)
+        _log_event(f"{evt}_PAGE", admin=q.from_user.id, page=page, total=total)
+        await q.edit_message_reply_markup(reply_markup=kb)
+        return states.SELECT_USER
+
+    @admin_only
+    async def find_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        await q.edit_message_text("Scrivi una parte del nome/cognome da cercare:")
+        return states.FIND_USER
+
+    async def find_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        qtxt = (update.message.text or "").strip()
+        if len(qtxt) < 2:
+            await update.message.reply_text("Inserisci almeno 2 caratteri.")
+            return states.FIND_USER
+        rows = await search_users_by_name(qtxt)
+        _log_event(f"{evt}_FIND", query=qtxt, results=len(rows))
+        if not rows:
+            await update.message.reply_text("Nessun risultato. Riprova.")
+            return states.FIND_USER
+        await update.message.reply_text(
+            f'Risultati per "{_md(qtxt)}":',
+            reply_markup=build_search_kb(rows, qtxt)
+        )
+        return states.SELECT_USER
+
+    @admin_only
+    async def pick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        uid = int(q.data.split(":",1)[1])
+        context.user_data.setdefault(key, FlowState()).user_id = uid
+        _log_event(f"{evt}_PICK_USER", admin=q.from_user.id, user_id=uid)
+        await q.edit_message_text(
+            f"✏️ Inserisci i kWh da {verb} (es. 10 o 15,345):",
+            reply_markup=pick_kb(uid) if pick_kb else None
+        )
+        return states.ASK_AMOUNT
+
+    async def amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        amount = _parse_amount((update.message.text or "").strip())
+        if amount is None:
+            await update.message.reply_text("⚠️ Inserisci i kWh ricaricati (es. 10 o 15,345).")
+            return states.ASK_AMOUNT
+        if amount <= 0:
+            await update.message.reply_text("⚠️ Il valore deve essere maggiore di zero.")
+            return states.ASK_AMOUNT
+        if amount > MAX_CREDIT_PER_OP:
+            await update.message.reply_text(f"L'importo massimo per singola operazione è {MAX_CREDIT_PER_OP:g} kWh.")
+            return states.ASK_AMOUNT
+
+        context.user_data[key].amount = amount
+        _log_event(f"{evt}_AMOUNT_SET", amount=amount)
+        await update.message.reply_text(
+            f"Ok, {noun} *{amount:g} kWh*.\nVuoi indicare lo slot?",
+            reply_markup=slot_kb
+        )
+        return states.ASK_SLOT
 
-async def on_ac_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    slot = None
-    if q.data.startswith("ACS:"):
+    async def slot_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
         _s = q.data.split(":",1)[1]
         slot = None if _s == "-" else _s
-    context.user_data['ac']['slot'] = slot
-    _log_event("AC_SLOT_SET", slot=slot)
-
-    data = context.user_data['ac']
-    uid = data['user_id']; amount = data['amount']; slot = data.get('slot')
-    text = f"Confermi l'accredito di **{amount:g} kWh** all'utente `{uid}`" + (f" (slot {slot})" if slot else "") + "?"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Conferma", callback_data="ACC:OK"),
-         InlineKeyboardButton("❌ Annulla",  callback_data="ACC:NO")]
-    ])
-    await q.edit_message_text(text, reply_markup=kb)
-    return ACState.CONFIRM
-
-async def on_ac_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if q.data == "ACC:NO":
-        await q.edit_message_text("Operazione annullata.")
+        data = context.user_data[key]
+        data.slot = slot
+        _log_event(f"{evt}_SLOT_SET", slot=slot)
+
+        uid, amount = data.user_id, data.amount
+        text = f"Confermi l'{noun} di *{amount:g} kWh* all'utente `{uid}`" + (f" (slot {_md(slot)})" if slot else "") + "?"
+        await q.edit_message_text(text, reply_markup=confirm_kb)
+        return states.CONFIRM
+
+    async def confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        q = update.callback_query
+        await q.answer()
+        # Terminal step: take the flow data out of user_data once, freeing it either way
+        data = context.user_data.pop(key, None)
+        if data is None or q.data.endswith(":NO"):
+            await q.edit_message_text("Operazione annullata.")
+            return ConversationHandler.END
+
+        uid, amount, slot = data.user_id, data.amount, data.slot
+        ok, old_bal, new_bal, name, tg = await apply_fn(uid, amount, slot, q.from_user.id)
+        if not ok:
+            _log_event(f"{evt}_{op_evt}_FAIL", user_id=uid, amount=amount)
+            # A debit refused by the negative policy reports the unchanged balance
+            if debit and old_bal is not None and old_bal == new_bal and (old_bal - amount) < 0:
+                await q.edit_message_text("❗ Saldo insufficiente e negativo non consentito per questo utente.")
+            else:
+                await q.edit_message_text("❗ Errore: limiti o saldo insufficiente.")
+            return ConversationHandler.END
+
+        summary = (
+            f"✅ *{title}*\n\n"
+            f"*Utente:* {_md(name or uid)}\n"
+            f"*Quantità:* {amount:g} kWh{f' (slot {_md(slot)})' if slot else ''}\n\n"
+            f"*Saldo prima:* {old_bal:.2f} kWh\n"
+            f"*Saldo dopo:*  {new_bal:.2f} kWh"
+        )
+        # Admin summary and user notice are independent: send both concurrently
+        await asyncio.gather(
+            q.edit_message_text(summary),
+            _send_to_user(context, tg, f"{notice} {amount:g} kWh.\nSaldo: {old_bal:.2f} → {new_bal:.2f} kWh"),
+        )
+        _log_event(f"{evt}_{op_evt}_OK", user_id=uid, amount=amount, old=old_bal, new=new_bal)
         return ConversationHandler.END
 
-    data = context.user_data.get('ac', {})
-    uid = data['user_id']
-    amount = data['amount']
-    slot = data.get('slot')
-    admin_id = q.from_user.id
+    return start, users_page, find_press, find_query, pick_user, amount_step, slot_step, confirm
 
-    ok, old_bal, new_bal = await accredita_kwh(uid, amount, slot, admin_id)
-    if not ok:
-        _log_event("AC_CREDIT_FAIL", user_id=uid, amount=amount)
-        await q.edit_message_text("❗ Errore: limiti o saldo insufficiente.")
-        return ConversationHandler.END
-
-    name = await _get_user_name(uid)
-    summary = (
-        f"✅ *Accredito completato*\n\n"
-        f"*Utente:* {name or uid}\n"
-        f"*Quantità:* {amount:g} kWh{f' (slot {slot})' if slot else ''}\n\n"
-        f"*Saldo prima:* {old_bal:.2f} kWh\n"
-        f"*Saldo dopo:*  {new_bal:.2f} kWh"
-    )
-    await q.edit_message_text(summary)
+def _history_kb(uid: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("📜 Storico ultime 10", callback_data=f"ACH:{uid}")]])
 
-    try:
-        tg = await get_tgid_by_userid(uid)
-        if tg:
-            await context.bot.send_message(
-                chat_id=tg,
-                text=f"✅ Ti sono stati accreditati {amount:g} kWh.\nSaldo: {old_bal:.2f} → {new_bal:.2f} kWh"
-            )
-    except Exception:
-        pass
-    _log_event("AC_CREDIT_OK", user_id=uid, amount=amount, old=old_bal, new=new_bal)
+(on_ac_start, on_ac_users_page, on_ac_find_press, on_ac_find_query,
+ on_ac_pick_user, on_ac_amount, on_ac_slot, on_ac_confirm) = _make_wallet_flow(
+    "ac", ACState, accredita_kwh, _ACS_KB, _AC_CONFIRM_KB,
+    verb="accreditare", noun="accredito", title="Accredito completato",
+    notice="✅ Ti sono stati accreditati", pick_kb=_history_kb,
+)
 
-    return ConversationHandler.END
+(on_ad_start, on_ad_users_page, on_ad_find_press, on_ad_find_query,
+ on_ad_pick_user, on_ad_amount, on_ad_slot, on_ad_confirm) = _make_wallet_flow(
+    "ad", ADState, addebita_kwh, _ADS_KB, _AD_CONFIRM_KB,
+    verb="addebitare", noun="addebito", title="Addebito completato",
+    notice="⚠️ Ti sono stati *addebitati*", debit=True,
+)
 
 async def on_ac_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -1192,185 +1773,9 @@ async def on_ac_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not rows:
         await q.edit_message_text("Nessuna operazione registrata per questo utente.")
         return ACState.SELECT_USER
-    lines = ["📜 *Ultime 10 operazioni*",""]
-    for created_at, delta, reason, slot, admin_id in rows:
-        sign = "➕" if delta >= 0 else "➖"
-        sslot = f" (slot {slot})" if slot else ""
-        lines.append(f"{created_at} — {sign}{abs(delta):g} kWh • {reason}{sslot}")
-    await q.edit_message_text("\n".join(lines))
+    await q.edit_message_text(f"📜 *Ultime 10 operazioni*\n\n{_format_ops(rows)}")
     return ACState.SELECT_USER
 
-# ====================
-# ADMIN DEBIT FLOW (AD) - Existing admin functions
-# ====================
-
-async def on_ad_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        await q.edit_message_text("Funzione riservata agli admin.")
-        return ConversationHandler.END
-    context.user_data['ad'] = {}
-    rows, total = await fetch_users_page(0)
-    _log_event("AD_START", admin=q.from_user.id, page=0, total=total)
-    await q.edit_message_text(
-        "Seleziona l'utente da addebitare:",
-        reply_markup=build_users_kb(rows, 0, total)
-    )
-    return ADState.SELECT_USER
-
-async def on_ad_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    page = int(q.data.split(":",1)[1])
-    rows, total = await fetch_users_page(page)
-    _log_event("AD_PAGE", admin=q.from_user.id, page=page, total=total)
-    await q.edit_message_reply_markup(reply_markup=build_users_kb(rows, page, total))
-    return ADState.SELECT_USER
-
-async def on_ad_find_press(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    await q.edit_message_text("Scrivi una parte del nome/cognome da cercare:")
-    return ADState.FIND_USER
-
-async def on_ad_find_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    qtxt = (update.message.text or "").strip()
-    if len(qtxt) < 2:
-        await update.message.reply_text("Inserisci almeno 2 caratteri.")
-        return ADState.FIND_USER
-    rows = await search_users_by_name(qtxt)
-    _log_event("AD_FIND", query=qtxt, results=len(rows))
-    if not rows:
-        await update.message.reply_text("Nessun risultato. Riprova.")
-        return ADState.FIND_USER
-    await update.message.reply_text(
-        f'Risultati per "{qtxt}":',
-        reply_markup=build_search_kb(rows, qtxt)
-    )
-    return ADState.SELECT_USER
-
-async def on_ad_pick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if not _is_admin(q.from_user.id):
-        return ConversationHandler.END
-    if not (q.data.startswith("ACU:") or q.data.startswith("ADU:")):
-        return ConversationHandler.END
-    uid = int(q.data.split(":",1)[1])
-    context.user_data.setdefault('ad', {})['user_id'] = uid
-    _log_event("AD_PICK_USER", admin=q.from_user.id, user_id=uid)
-
-    await q.edit_message_text("✏️ Inserisci i kWh da addebitare (es. 10 o 15,345).")
-    return ADState.ASK_AMOUNT
-
-async def on_ad_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = (update.message.text or "").strip()
-    if not _is_number(txt):
-        await update.message.reply_text("⚠️ Inserisci i kWh ricaricati (es. 10 o 15,345).")
-        return ADState.ASK_AMOUNT
-    amount = round(float(txt.replace(",", ".")), 3)
-    if amount <= 0:
-        await update.message.reply_text("⚠️ Il valore deve essere maggiore di zero.")
-        return ADState.ASK_AMOUNT
-    if amount > MAX_CREDIT_PER_OP:
-        await update.message.reply_text(f"Massimo per singola operazione: {MAX_CREDIT_PER_OP:g}.")
-        return ADState.ASK_AMOUNT
-
-    context.user_data['ad']['amount'] = amount
-    _log_event("AD_AMOUNT_SET", amount=amount)
-    
-    # Build slot buttons dynamically
-    slot_buttons = []
-    for slot in SLOTS[:3]:
-        slot_buttons.append(InlineKeyboardButton(slot.title(), callback_data=f"ADS:{slot}"))
-    
-    kb_rows = [slot_buttons]
-    if len(SLOTS) > 3:
-        more_buttons = []
-        for slot in SLOTS[3:6]:
-            more_buttons.append(InlineKeyboardButton(slot.title(), callback_data=f"ADS:{slot}"))
-        if more_buttons:
-            kb_rows.append(more_buttons)
-    
-    kb_rows.append([InlineKeyboardButton("Salta", callback_data="ADS:-")])
-    kb = InlineKeyboardMarkup(kb_rows)
-    
-    await update.message.reply_text(
-        f"Ok, addebito **{amount:g} kWh**.\nVuoi indicare lo slot?",
-        reply_markup=kb
-    )
-    return ADState.ASK_SLOT
-
-async def on_ad_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    slot = None
-    if q.data.startswith("ADS:"):
-        _s = q.data.split(":",1)[1]
-        slot = None if _s == "-" else _s
-    context.user_data['ad']['slot'] = slot
-    _log_event("AD_SLOT_SET", slot=slot)
-
-    data = context.user_data['ad']
-    uid = data['user_id']; amount = data['amount']; slot = data.get('slot')
-    text = f"Confermi l'*addebito* di **{amount:g} kWh** all'utente `{uid}`" + (f" (slot {slot})" if slot else "") + "?"
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Conferma", callback_data="ADD:OK"),
-         InlineKeyboardButton("❌ Annulla",  callback_data="ADD:NO")]
-    ])
-    await q.edit_message_text(text, reply_markup=kb)
-    return ADState.CONFIRM
-
-async def on_ad_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    if q.data == "ADD:NO":
-        await q.edit_message_text("Operazione annullata.")
-        return ConversationHandler.END
-
-    data = context.user_data.get('ad', {})
-    uid = data['user_id']
-    amount = data['amount']
-    slot = data.get('slot')
-    admin_id = q.from_user.id
-
-    ok, old_bal, new_bal = await addebita_kwh(uid, amount, slot, admin_id)
-    if not ok:
-        _log_event("AD_DEBIT_FAIL", user_id=uid, amount=amount)
-        if old_bal is not None and new_bal is not None and old_bal == new_bal and (old_bal - amount) < 0:
-            await q.edit_message_text("❗ Saldo insufficiente e negativo non consentito per questo utente.")
-        else:
-            await q.edit_message_text("❗ Errore: limiti o saldo insufficiente.")
-        return ConversationHandler.END
-
-    name = await _get_user_name(uid)
-    summary = (
-        f"✅ *Addebito completato*\n\n"
-        f"*Utente:* {name or uid}\n"
-        f"*Quantità:* {amount:g} kWh{f' (slot {slot})' if slot else ''}\n\n"
-        f"*Saldo prima:* {old_bal:.2f} kWh\n"
-        f"*Saldo dopo:*  {new_bal:.2f} kWh"
-    )
-    await q.edit_message_text(summary)
-
-    try:
-        tg = await get_tgid_by_userid(uid)
-        if tg:
-            await context.bot.send_message(
-                chat_id=tg,
-                text=f"⚠️ Ti sono stati *addebitati* {amount:g} kWh.\nSaldo: {old_bal:.2f} → {new_bal:.2f} kWh"
-            )
-    except Exception:
-        pass
-    _log_event("AD_DEBIT_OK", user_id=uid, amount=amount, old=old_bal, new=new_bal)
-
-    return ConversationHandler.END
-
 # ====================
 # USER CREDIT REQUEST FLOW (CR) - NEW
 # ====================
@@ -1393,24 +1798,10 @@ async def cmd_ricarica(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['cr'] = {}
     _log_event("CR_START", user_id=user_id)
     
-    # Build slot selection keyboard (3 per riga)
-    rows = []
-    row = []
-    for slot in SLOTS:
-        row.append(InlineKeyboardButton(slot.title(), callback_data=f"CRS:{slot}"))
-        if len(row) == 3:
-            rows.append(row)
-            row = []
-    if row:
-        rows.append(row)
-    if not rows:
-        rows = [[InlineKeyboardButton("Wallet", callback_data="CRS:wallet")]]
-    kb = InlineKeyboardMarkup(rows)
-    
     await update.message.reply_text(
         "📋 *Richiesta di Ricarica*\n\n"
         "Seleziona lo slot da ricaricare:",
-        reply_markup=kb
+        reply_markup=_CR_SLOT_KB
     )
     return CRState.ASK_SLOT
 
@@ -1424,7 +1815,7 @@ async def on_cr_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _log_event("CR_SLOT_SET", slot=slot)
     
     await q.edit_message_text(
-        f"📍 Slot selezionato: *{slot}*\n\n"
+        f"📍 Slot selezionato: {_md(slot)}\n\n"
         f"Inserisci i kWh da ricaricare (es. 10 o 15,345):"
     )
     return CRState.ASK_KWH
@@ -1432,11 +1823,10 @@ async def on_cr_slot(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def on_cr_kwh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle kWh input"""
     txt = (update.message.text or "").strip()
-    if not _is_number(txt):
+    kwh = _parse_amount(txt)
+    if kwh is None:
         await update.message.reply_text("⚠️ ⚠️ Inserisci i kWh ricaricati (es. 10 o 15,345).")
         return CRState.ASK_KWH
-    
-    kwh = round(float(txt.replace(",", ".")), 3)
     if kwh <= 0:
         await update.message.reply_text("⚠️ Il valore deve essere maggiore di zero.")
         return CRState.ASK_KWH
@@ -1457,17 +1847,9 @@ async def on_cr_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Devi inviare una foto. Riprova.")
         return CRState.ASK_PHOTO
     
-    # Download and save photo
-    photo = update.message.photo[-1]  # Highest resolution
-    file = await context.bot.get_file(photo.file_id)
-    
-    # Generate unique filename
-    user_id = update.effective_user.id
-    filename = f"{user_id}_{uuid.uuid4().hex[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-    photo_path = os.path.join(CREDIT_PHOTOS_PATH, filename)
-    
+    # Download and save photo (highest resolution)
     try:
-        await file.download_to_drive(photo_path)
+        photo_path = await _save_credit_photo(context, update.message.photo[-1])
         context.user_data['cr']['photo_path'] = photo_path
         _log_event("CR_PHOTO_SAVED", path=photo_path)
     except Exception as e:
@@ -1487,58 +1869,37 @@ async def on_cr_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return CRState.ASK_NOTE
 
+def _cr_summary_text(slot: str, kwh: float, note: str | None) -> str:
+    return (
+        f"📋 Riepilogo richiesta\n\n"
+        f"📍 Slot: {_md(slot)}\n"
+        f"⚡ kWh: {kwh:g}\n"
+        f"📸 Foto: allegata\n"
+        f"📝 Nota: {_md(note) if note else '_nessuna_'}\n\n"
+        f"Confermi l'invio?"
+    )
+
 async def on_cr_skip_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle skip note button"""
     q = update.callback_query
     await q.answer()
     
-    context.user_data['cr']['note'] = None
-    
-    # Show confirmation
     data = context.user_data['cr']
-    slot = data['slot']
-    kwh = data['kwh']
-    
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Conferma", callback_data="CRC:OK"),
-         InlineKeyboardButton("❌ Annulla", callback_data="CRC:NO")]
-    ])
-    
+    data['note'] = None
     await q.edit_message_text(
-        f"📋 Riepilogo richiesta\n\n"
-        f"📍 Slot: {slot}\n"
-        f"⚡ kWh: {kwh:g}\n"
-        f"📸 Foto: allegata\n"
-        f"📝 Nota: _nessuna_\n\n"
-        f"Confermi l'invio?",
-        reply_markup=kb
+        _cr_summary_text(data['slot'], data['kwh'], None),
+        reply_markup=_CR_CONFIRM_KB
     )
     return CRState.CONFIRM
 
 async def on_cr_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle note input"""
-    note = (update.message.text or "").strip()
-    context.user_data['cr']['note'] = note if note else None
-    
-    # Show confirmation
+    note = (update.message.text or "").strip() or None
     data = context.user_data['cr']
-    slot = data['slot']
-    kwh = data['kwh']
-    note_text = note if note else "_nessuna_"
-    
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Conferma", callback_data="CRC:OK"),
-         InlineKeyboardButton("❌ Annulla", callback_data="CRC:NO")]
-    ])
-    
+    data['note'] = note
     await update.message.reply_text(
-        f"📋 Riepilogo richiesta\n\n"
-        f"📍 Slot: {slot}\n"
-        f"⚡ kWh: {kwh:g}\n"
-        f"📸 Foto: allegata\n"
-        f"📝 Nota: {note_text}\n\n"
-        f"Confermi l'invio?",
-        reply_markup=kb
+        _cr_summary_text(data['slot'], data['kwh'], note),
+        reply_markup=_CR_CONFIRM_KB
     )
     return CRState.CONFIRM
 
@@ -1549,12 +1910,7 @@ async def on_cr_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if q.data == "CRC:NO":
         # Clean up photo if exists
-        photo_path = context.user_data.get('cr', {}).get('photo_path')
-        if photo_path and os.path.exists(photo_path):
-            try:
-                os.remove(photo_path)
-            except Exception:
-                pass
+        await _remove_photo(context.user_data.get('cr', {}).get('photo_path'))
         
         await q.edit_message_text("❌ Richiesta annullata.")
         return ConversationHandler.END
@@ -1569,19 +1925,30 @@ async def on_cr_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         request_id = await create_credit_request(user_id, slot, kwh, photo_path, note)
+        if request_id is None:
+            await _remove_photo(photo_path)
+            await q.edit_message_text(
+                f"⚠️ Hai già {MAX_PENDING_REQUESTS} richieste in attesa.\n"
+                f"Attendi che vengano elaborate prima di inviarne altre."
+            )
+            return ConversationHandler.END
         _log_event("CR_CREATED", request_id=request_id, user_id=user_id, slot=slot, kwh=kwh)
         
         await q.edit_message_text(
             f"✅ *Richiesta inviata!*\n\n"
             f"📋 Richiesta #{request_id}\n"
-            f"📍 Slot: {slot}\n"
+            f"📍 Slot: {_md(slot)}\n"
             f"⚡ kWh: {kwh:g}\n\n"
             f"Ti avviseremo appena un amministratore la verifica.\n"
             f"Usa /pending per controllare lo stato."
         )
         
-        # Notify admins
-        await notify_admins(context, request_id, user_id, slot, kwh, photo_path, note)
+        # Notify admins in the background: the user's reply doesn't wait on the fan-out,
+        # and errors still reach handle_error through the application
+        context.application.create_task(
+            notify_admins(context, request_id, user_id, slot, kwh, photo_path, note),
+            update=update,
+        )
         
     except Exception as e:
         log.exception("Failed to create credit request: %s", e)
@@ -1598,19 +1965,7 @@ async def on_photo_with_caption(update: Update, context: ContextTypes.DEFAULT_TY
     if not update.message.photo or not update.message.caption:
         return
     
-    user_id = update.effective_user.id
-    await ensure_user(user_id, update.effective_user.full_name)
-    
-    # Check pending limit
-    pending_count = await count_user_pending_requests(user_id)
-    if pending_count >= MAX_PENDING_REQUESTS:
-        await update.message.reply_text(
-            f"⚠️ Hai già {pending_count} richieste in attesa.\n"
-            f"Massimo: {MAX_PENDING_REQUESTS}. Attendi l'elaborazione."
-        )
-        return
-    
-    # Parse caption
+    # Parse and validate the caption first: a malformed one costs no DB or Telegram call
     caption = update.message.caption.strip()
     parts = caption.split(maxsplit=2)
     
@@ -1622,35 +1977,40 @@ async def on_photo_with_caption(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     slot = parts[0].lower()
-    kwh_str = parts[1].replace(",", ".")
     note = parts[2] if len(parts) > 2 else None
     
     # Validate slot
-    if slot not in [s.lower() for s in SLOTS]:
+    if slot not in _SLOTS_LOWER:
         await update.message.reply_text(
-            f"⚠️ Slot non valido: {slot}\n"
-            f"Slot disponibili: {', '.join(SLOTS)}"
+            f"⚠️ Slot non valido: {_md(slot)}\n"
+            f"Slot disponibili: {_md(', '.join(SLOTS))}"
         )
         return
     
-    # Validate kWh
-    if not _is_number(kwh_str):
+    # Validate kWh ("4.5" and "4,5" alike)
+    kwh = _parse_amount(parts[1])
+    if kwh is None:
         await update.message.reply_text("⚠️ Quantità kWh non valida.")
         return
-    
-    kwh = round(float(kwh_str), 3)
     if kwh <= 0:
         await update.message.reply_text("⚠️ Il valore deve essere maggiore di zero.")
         return
     
-    # Download photo
-    photo = update.message.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-    filename = f"{user_id}_{uuid.uuid4().hex[:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-    photo_path = os.path.join(CREDIT_PHOTOS_PATH, filename)
+    user_id = update.effective_user.id
+    await ensure_user(user_id, update.effective_user.full_name)
+    
+    # Check pending limit
+    pending_count = await count_user_pending_requests(user_id)
+    if pending_count >= MAX_PENDING_REQUESTS:
+        await update.message.reply_text(
+            f"⚠️ Hai già {pending_count} richieste in attesa.\n"
+            f"Massimo: {MAX_PENDING_REQUESTS}. Attendi l'elaborazione."
+        )
+        return
     
+    # Download photo
     try:
-        await file.download_to_drive(photo_path)
+        photo_path = await _save_credit_photo(context, update.message.photo[-1])
     except Exception as e:
         log.exception("Failed to save photo: %s", e)
         await update.message.reply_text("❗ Errore nel salvataggio della foto.")
@@ -1659,18 +2019,28 @@ async def on_photo_with_caption(update: Update, context: ContextTypes.DEFAULT_TY
     # Create request
     try:
         request_id = await create_credit_request(user_id, slot, kwh, photo_path, note)
+        if request_id is None:
+            await _remove_photo(photo_path)
+            await update.message.reply_text(
+                f"⚠️ Hai già {MAX_PENDING_REQUESTS} richieste in attesa. Attendi l'elaborazione."
+            )
+            return
         _log_event("CR_CREATED_PHOTO", request_id=request_id, user_id=user_id, slot=slot, kwh=kwh)
         
         await update.message.reply_text(
             f"✅ *Richiesta inviata!*\n\n"
             f"📋 #{request_id}\n"
-            f"📍 {slot} | ⚡ {kwh:g} kWh\n"
-            f"{'📝 ' + note if note else ''}\n\n"
+            f"📍 {_md(slot)} | ⚡ {kwh:g} kWh\n"
+            f"{'📝 ' + _md(note) if note else ''}\n\n"
             f"Ti avviseremo dell'esito."
         )
         
-        # Notify admins
-        await notify_admins(context, request_id, user_id, slot, kwh, photo_path, note)
+        # Notify admins in the background: the user's reply doesn't wait on the fan-out,
+        # and errors still reach handle_error through the application
+        context.application.create_task(
+            notify_admins(context, request_id, user_id, slot, kwh, photo_path, note),
+            update=update,
+        )
         
     except Exception as e:
         log.exception("Failed to create credit request from photo: %s", e)
@@ -1680,15 +2050,12 @@ async def on_photo_with_caption(update: Update, context: ContextTypes.DEFAULT_TY
 # CREDIT REQUEST APPROVAL/REJECTION CALLBACKS - NEW
 # ====================
 
+@admin_only
 async def on_cr_approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle credit request approval"""
     q = update.callback_query
     await q.answer()
     
-    if not _is_admin(q.from_user.id):
-        await q.answer("Non sei autorizzato.", show_alert=True)
-        return
-    
     request_id = int(q.data.split(":")[1])
     admin_id = q.from_user.id
     
@@ -1699,11 +2066,9 @@ async def on_cr_approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("⚠️ Richiesta non trovata.")
         return
     
-    _, user_id, slot, kwh, photo_path, note, status, created_at, _, _ = req
-    
-    if status != 'pending':
+    if req["status"] != 'pending':
         await q.edit_message_reply_markup(reply_markup=None)
-        await q.message.reply_text(f"⚠️ Richiesta già {status}.")
+        await q.message.reply_text(f"⚠️ Richiesta già {req['status']}.")
         return
     
     # Approve request
@@ -1715,24 +2080,21 @@ async def on_cr_approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_reply_markup(reply_markup=None)
         await q.message.reply_text(
             f"✅ *Richiesta #{request_id} APPROVATA*\n"
-            f"da {admin_name}\n\n"
+            f"da {_md(admin_name)}\n\n"
             f"{details}"
         )
         
         # Notify user
-        await notify_user_request_result(context, user_id, True, kwh, slot, details)
+        await notify_user_request_result(context, req["tg_id"], True, req["kwh"], req["slot"], details)
     else:
         await q.answer(f"❌ Errore: {details}", show_alert=True)
 
+@admin_only
 async def on_cr_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle credit request rejection"""
     q = update.callback_query
     await q.answer()
     
-    if not _is_admin(q.from_user.id):
-        await q.answer("Non sei autorizzato.", show_alert=True)
-        return
-    
     request_id = int(q.data.split(":")[1])
     admin_id = q.from_user.id
     
@@ -1743,11 +2105,9 @@ async def on_cr_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("⚠️ Richiesta non trovata.")
         return
     
-    _, user_id, slot, kwh, photo_path, note, status, created_at, _, _ = req
-    
-    if status != 'pending':
+    if req["status"] != 'pending':
         await q.edit_message_reply_markup(reply_markup=None)
-        await q.message.reply_text(f"⚠️ Richiesta già {status}.")
+        await q.message.reply_text(f"⚠️ Richiesta già {req['status']}.")
         return
     
     # Reject request
@@ -1759,11 +2119,11 @@ async def on_cr_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_reply_markup(reply_markup=None)
         await q.message.reply_text(
             f"❌ *Richiesta #{request_id} RIFIUTATA*\n"
-            f"da {admin_name}"
+            f"da {_md(admin_name)}"
         )
         
         # Notify user
-        await notify_user_request_result(context, user_id, False, kwh, slot, "")
+        await notify_user_request_result(context, req["tg_id"], False, req["kwh"], req["slot"], "")
     else:
         await q.answer(f"❌ Errore: {details}", show_alert=True)
 
@@ -1774,14 +2134,12 @@ async def on_cr_reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def on_admin_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
         _log_event("CMD_ADMIN_MENU", caller=update.effective_user.id)
-        await update.message.reply_text("Pannello admin:", reply_markup=admin_home_kb())
+        await update.message.reply_text("Pannello admin:", reply_markup=_ADMIN_HOME_KB)
 
+@admin_only
 async def on_allowneg_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
-    if not _is_admin(q.from_user.id):
-        await q.edit_message_text("Funzione riservata agli admin.")
-        return
     _, payload = q.data.split("ALN_SET:",1)
     uid_str, mode = payload.split(":")
     uid = int(uid_str)
@@ -1806,26 +2164,110 @@ async def on_nop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
+# Top-level (non-conversation) callbacks, dispatched on the callback_data prefix; each
+# route keeps its full-match pattern so malformed data stays unclaimed.
+# ACH also arrives while ac_conv is in ASK_AMOUNT (the history button under the
+# amount prompt), a state where the conversation doesn't match it
+_CB_ROUTER = {
+    "CR_APPROVE": (re.compile(r"CR_APPROVE:\d+"), on_cr_approve),
+    "CR_REJECT": (re.compile(r"CR_REJECT:\d+"), on_cr_reject),
+    "ALN_SET": (re.compile(r"ALN_SET:\d+:(on|off|default)"), on_allowneg_set),
+    "ACH": (_PAT_ACH, on_ac_history),
+    "NOP": (re.compile(r"NOP"), on_nop),
+}
+
+def _is_routed(data: object) -> bool:
+    if not isinstance(data, str):
+        return False
+    route = _CB_ROUTER.get(data.partition(":")[0])
+    # One dict lookup and one regex instead of one regex per registered handler
+    return route is not None and route[0].fullmatch(data) is not None
+
+async def on_routed_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _CB_ROUTER[update.callback_query.data.partition(":")[0]][1](update, context)
+
 # ====================
 # ERROR HANDLER
 # ====================
 
 async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    err = context.error
-    log.exception("GLOBAL_ERROR: %s", err)
+    log.error("GLOBAL_ERROR", exc_info=context.error)
 
 # ====================
 # APPLICATION BUILDER
 # ====================
 
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Run different users' updates in parallel but each user's updates one at a time.
+
+    ConversationHandler records the new state only after a step returns, so a user's next
+    message or tap must not start before that; other users need not wait for it.
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, list] = {}  # {user/chat id: [lock, updates holding or waiting]}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        key = user.id if user else (chat.id if chat else None)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 def build_application(token: str | None = None) -> Application:
-    app = Application.builder().token(token or os.getenv("TELEGRAM_TOKEN")).build()
+    app = (
+        Application.builder()
+        .token(token or os.getenv("TELEGRAM_TOKEN"))
+        # A slow SQLite write or photo download no longer queues other users; one user's
+        # updates stay in order, as the conversations require
+        .concurrent_updates(PerUserUpdateProcessor())
+        # PTB keeps a 256-connection keep-alive pool for Bot API calls; give admin fan-outs
+        # room to wait for a free connection and photo uploads time to complete
+        .connect_timeout(5.0)
+        .read_timeout(15.0)
+        .pool_timeout(5.0)
+        # Smooth bursts (admin fan-out, confirm + user notice) just under the 30 msg/s bot-wide
+        # and 20 msg/min per-group caps instead of hitting 429s; RetryAfter is retried transparently
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=25, overall_time_period=1,
+            group_max_rate=18, group_time_period=60,
+            max_retries=3,
+        ))
+        # Texts use *bold*/_italic_ markup: render it everywhere without per-call kwargs
+        # (user-supplied fragments go through _md)
+        .defaults(Defaults(parse_mode=ParseMode.MARKDOWN))
+        .build()
+    )
 
     async def _post_init(app_: Application):
         await init_db()
+        await get_db()
+        await get_read_db()
         _log_event("APP_READY", version=__VERSION__)
     app.post_init = _post_init
 
+    async def _post_shutdown(app_: Application):
+        await stop_credit_request_writer()
+        await close_db()
+    app.post_shutdown = _post_shutdown
+
     # Commands
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("ping", cmd_ping))
@@ -1839,18 +2281,18 @@ def build_application(token: str | None = None) -> Application:
 
     # Admin Credit flow (existing)
     ac_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(on_ac_start, pattern="^AC_START$")],
+        entry_points=[CallbackQueryHandler(on_ac_start, pattern=_PAT_AC_START)],
         states={
             ACState.SELECT_USER: [
-                CallbackQueryHandler(on_ac_pick_user, pattern="^ACU:"),
-                CallbackQueryHandler(on_ac_users_page, pattern="^ACP:\\d+$"),
-                CallbackQueryHandler(on_ac_find_press, pattern="^AC_FIND$"),
-                CallbackQueryHandler(on_ac_history, pattern="^ACH:\\d+$"),
+                CallbackQueryHandler(on_ac_pick_user, pattern=_PAT_ACU),
+                CallbackQueryHandler(on_ac_users_page, pattern=_PAT_ACP),
+                CallbackQueryHandler(on_ac_find_press, pattern=_PAT_AC_FIND),
+                CallbackQueryHandler(on_ac_history, pattern=_PAT_ACH),
             ],
             ACState.FIND_USER:   [MessageHandler(filters.TEXT & ~filters.COMMAND, on_ac_find_query)],
             ACState.ASK_AMOUNT:  [MessageHandler(filters.TEXT & ~filters.COMMAND, on_ac_amount)],
-            ACState.ASK_SLOT:    [CallbackQueryHandler(on_ac_slot, pattern="^ACS:")],
-            ACState.CONFIRM:     [CallbackQueryHandler(on_ac_confirm, pattern="^ACC:(OK|NO)$")],
+            ACState.ASK_SLOT:    [CallbackQueryHandler(on_ac_slot, pattern=_PAT_ACS)],
+            ACState.CONFIRM:     [CallbackQueryHandler(on_ac_confirm, pattern=_PAT_ACC)],
         },
         fallbacks=[],
         name="admin_credit_flow",
@@ -1860,17 +2302,17 @@ def build_application(token: str | None = None) -> Application:
 
     # Admin Debit flow (existing)
     ad_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(on_ad_start, pattern="^AD_START$")],
+        entry_points=[CallbackQueryHandler(on_ad_start, pattern=_PAT_AD_START)],
         states={
             ADState.SELECT_USER: [
-                CallbackQueryHandler(on_ad_pick_user, pattern="^(ACU|ADU):"),
-                CallbackQueryHandler(on_ad_users_page, pattern="^ACP:\\d+$"),
-                CallbackQueryHandler(on_ad_find_press, pattern="^AC_FIND$"),
+                CallbackQueryHandler(on_ad_pick_user, pattern=_PAT_ACU_ADU),
+                CallbackQueryHandler(on_ad_users_page, pattern=_PAT_ACP),
+                CallbackQueryHandler(on_ad_find_press, pattern=_PAT_AC_FIND),
             ],
             ADState.FIND_USER:   [MessageHandler(filters.TEXT & ~filters.COMMAND, on_ad_find_query)],
             ADState.ASK_AMOUNT:  [MessageHandler(filters.TEXT & ~filters.COMMAND, on_ad_amount)],
-            ADState.ASK_SLOT:    [CallbackQueryHandler(on_ad_slot, pattern="^ADS:")],
-            ADState.CONFIRM:     [CallbackQueryHandler(on_ad_confirm, pattern="^ADD:(OK|NO)$")],
+            ADState.ASK_SLOT:    [CallbackQueryHandler(on_ad_slot, pattern=_PAT_ADS)],
+            ADState.CONFIRM:     [CallbackQueryHandler(on_ad_confirm, pattern=_PAT_ADD)],
         },
         fallbacks=[],
         name="admin_debit_flow",
@@ -1882,14 +2324,14 @@ def build_application(token: str | None = None) -> Application:
     cr_conv = ConversationHandler(
         entry_points=[CommandHandler("ricarica", cmd_ricarica)],
         states={
-            CRState.ASK_SLOT:   [CallbackQueryHandler(on_cr_slot, pattern="^CRS:")],
+            CRState.ASK_SLOT:   [CallbackQueryHandler(on_cr_slot, pattern=_PAT_CRS)],
             CRState.ASK_KWH:    [MessageHandler(filters.TEXT & ~filters.COMMAND, on_cr_kwh)],
             CRState.ASK_PHOTO:  [MessageHandler(filters.PHOTO, on_cr_photo)],
             CRState.ASK_NOTE:   [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, on_cr_note),
-                CallbackQueryHandler(on_cr_skip_note, pattern="^CRN:skip$")
+                CallbackQueryHandler(on_cr_skip_note, pattern=_PAT_CRN_SKIP)
             ],
-            CRState.CONFIRM:    [CallbackQueryHandler(on_cr_confirm, pattern="^CRC:(OK|NO)$")],
+            CRState.CONFIRM:    [CallbackQueryHandler(on_cr_confirm, pattern=_PAT_CRC)],
         },
         fallbacks=[],
         name="user_credit_request_flow",
@@ -1900,14 +2342,8 @@ def build_application(token: str | None = None) -> Application:
     # Photo with caption handler (NEW)
     app.add_handler(MessageHandler(filters.PHOTO & filters.CAPTION, on_photo_with_caption), group=1)
 
-    # Credit request approval/rejection callbacks (NEW)
-    app.add_handler(CallbackQueryHandler(on_cr_approve, pattern="^CR_APPROVE:\\d+$"), group=0)
-    app.add_handler(CallbackQueryHandler(on_cr_reject, pattern="^CR_REJECT:\\d+$"), group=0)
-
-    # Inline misc
-    app.add_handler(CallbackQueryHandler(on_allowneg_set, pattern="^ALN_SET:\\d+:(on|off|default)$"), group=0)
-    app.add_handler(CallbackQueryHandler(on_ac_history, pattern="^ACH:\\d+$"), group=0)
-    app.add_handler(CallbackQueryHandler(on_nop, pattern="^NOP$"), group=0)
+    # Credit request approval/rejection and inline misc callbacks, see _CB_ROUTER
+    app.add_handler(CallbackQueryHandler(on_routed_callback, pattern=_is_routed), group=0)
 
     # Global error handler
     app.add_error_handler(handle_error)
@@ -1921,6 +2357,12 @@ create_application = build_application
 
 if __name__ == "__main__":
     import sys
+    # uvloop (pulled in by uvicorn[standard] on Linux) for faster dispatch; stdlib loop elsewhere
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     log.info("Starting bot in polling mode for testing...")
     app = build_application()
     app.run_polling()
@@ -64,6 +64,9 @@ async def on_startup():
 
     # Initialize/start PTB app
     await _application.initialize()
+    # run_polling/run_webhook call these hooks themselves; here we drive the app manually
+    if _application.post_init:
+        await _application.post_init(_application)
     await _application.start()
 
     url = f"{PUBLIC_URL}{WEBHOOK_PATH}"
@@ -89,6 +92,8 @@ async def on_shutdown():
         except Exception:
             pass
         await _application.stop()
+        if _application.post_shutdown:
+            await _application.post_shutdown(_application)
         await _application.shutdown()
     log.info("PTB application stopped.")
 